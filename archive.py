@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import zlib
+from datetime import datetime
+from auth import account_path, list_accounts
+from extract import DatabaseWriter
+from pipeline import run_pipeline
+
+ARCHIVE_DB = "archive.db"
+ARCHIVE_BATCH_SIZE = 200  # Messages per commit when storing
+
+
+def archive_path(account=""):
+    """The archive of an account. Each account has its own file, as message IDs
+    are only unique within a mailbox and concurrent runs don't share a lock."""
+    return account_path(account, ARCHIVE_DB)
+
+
+def archived_accounts():
+    """Return the accounts, "" being the default one, that have an archive."""
+    return [account for account in [""] + list_accounts() if os.path.exists(archive_path(account))]
+
+
+class EmailArchive:
+    """Local store of fetched HTML bodies, zlib-compressed and keyed by message_id.
+
+    Kept in its own database file so orders.db stays small. Lets the
+    extraction be re-run over old emails without downloading them again.
+    """
+
+    def __init__(self, db_path=ARCHIVE_DB, batch_size=ARCHIVE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = 0
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS raw_emails (
+                message_id TEXT,
+                part INTEGER,
+                fetched_at TEXT,
+                html BLOB,
+                PRIMARY KEY (message_id, part)
+            )"""
+        )
+        self.conn.commit()
+
+    def store(self, message_id, html_parts):
+        """Archive the HTML bodies (bytes or str) of one message."""
+        fetched_at = datetime.now().isoformat()
+        self.conn.execute("DELETE FROM raw_emails WHERE message_id = ?", (message_id,))
+        self.conn.executemany(
+            """INSERT INTO raw_emails (message_id, part, fetched_at, html)
+               VALUES (?, ?, ?, ?)""",
+            [
+                (message_id, part, fetched_at, zlib.compress(
+                    html if isinstance(html, bytes) else html.encode()
+                ))
+                for part, html in enumerate(html_parts)
+            ],
+        )
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Commit the messages stored so far."""
+        self.conn.commit()
+        self.pending = 0
+
+    def count(self):
+        """Return the number of archived messages."""
+        return self.conn.execute(
+            "SELECT COUNT(DISTINCT message_id) FROM raw_emails"
+        ).fetchone()[0]
+
+    def iter_messages(self):
+        """Yield (message_id, html_parts) for every archived message.
+
+        The HTML bodies are bytes, which the parser decodes itself.
+
+        Rows are streamed from the cursor, so memory use doesn't grow with
+        the size of the archive.
+        """
+        cursor = self.conn.execute(
+            "SELECT message_id, html FROM raw_emails ORDER BY message_id, part"
+        )
+        current_id, html_parts = None, []
+        for message_id, html in cursor:
+            if message_id != current_id:
+                if current_id is not None:
+                    yield current_id, html_parts
+                current_id, html_parts = message_id, []
+            html_parts.append(zlib.decompress(html))
+        if current_id is not None:
+            yield current_id, html_parts
+
+    def close(self):
+        """Commit pending messages and close the connection."""
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def replay_archive(writer=None, db_path=None, on_progress=None, account="", **pipeline_options):
+    """Re-extract every archived email of an account into the database, without any network.
+
+    Reads archive_path(account) unless db_path is given. Runs the archive
+    through pipeline.run_pipeline; extra keyword arguments (workers,
+    queue_size) are passed on. Every message is parsed again, even if its
+    content was ingested before. Messages are marked processed for account
+    when the writer is opened here. Returns the (msg_id, error) failures.
+    """
+    own_writer = writer is None
+    if own_writer:
+        writer = DatabaseWriter(account=account)
+    try:
+        with EmailArchive(db_path or archive_path(account)) as archive:
+            return run_pipeline(
+                archive.iter_messages(),
+                writer,
+                on_progress=on_progress,
+                dedup=False,
+                **pipeline_options,
+            )
+    finally:
+        if own_writer:
+            writer.close()
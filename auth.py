@@ -0,0 +1,190 @@
+import os
+import pickle
+import queue
+import tempfile
+import threading
+from contextlib import contextmanager
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+CLIENT_SECRETS_FILE = "credentials.json"
+TOKEN_FILE = "token.json"
+LEGACY_TOKEN_FILE = "token.pickle"  # Written by earlier versions
+ACCOUNTS_DIR = "accounts"  # One subdirectory per extra mailbox, holding its token.json
+SESSION_POOL_SIZE = 4
+HTTP_TIMEOUT = 60  # Seconds before a stalled Gmail call is given up and retried
+
+# The Google client libraries are imported inside the functions that use
+# them, so importing this module stays cheap.
+
+
+def _write_token(creds, path):
+    """Save credentials as JSON, readable by the current user only.
+
+    The JSON goes to a temporary file (mode 0600) that then replaces path,
+    so a crash never leaves a truncated token behind.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)  # A new account's directory
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".token-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as token:
+            token.write(creds.to_json())
+            token.flush()
+            os.fsync(token.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def list_accounts(directory=ACCOUNTS_DIR):
+    """Return the names of the accounts set up under directory, sorted.
+
+    An account is added by creating an empty accounts/<name> directory; the
+    consent flow stores its token there on the first run. The mailbox of
+    the root token.json is the default account, named "".
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name))
+    )
+
+
+def all_accounts():
+    """Return the default account, if it has a token, and the ones in ACCOUNTS_DIR."""
+    has_default = os.path.exists(TOKEN_FILE) or os.path.exists(LEGACY_TOKEN_FILE)
+    return ([""] if has_default else []) + list_accounts()
+
+
+def account_path(account, file_name):
+    """Path of file_name for an account: in the working directory for the default one."""
+    if not account:
+        return file_name
+    return os.path.join(ACCOUNTS_DIR, account, file_name)
+
+
+class CredentialManager:
+    """Loads, refreshes and stores the OAuth credentials of one mailbox.
+
+    Credentials are kept as JSON in token_path. An expired access token is
+    refreshed silently with the refresh token; the browser consent flow only
+    runs when there is no token yet or the refresh token was revoked.
+    A token.pickle left by an earlier version is converted once and removed.
+    """
+
+    def __init__(self, token_path=TOKEN_FILE, client_secrets=CLIENT_SECRETS_FILE, scopes=SCOPES):
+        self.token_path = token_path
+        self.client_secrets = client_secrets
+        self.scopes = scopes
+        self.creds = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_account(cls, account=""):
+        """The manager of an account's token; its own credentials.json is optional."""
+        client_secrets = account_path(account, CLIENT_SECRETS_FILE)
+        if not os.path.exists(client_secrets):
+            client_secrets = CLIENT_SECRETS_FILE  # All mailboxes can share one OAuth client
+        return cls(account_path(account, TOKEN_FILE), client_secrets)
+
+    def _load(self):
+        from google.oauth2.credentials import Credentials
+
+        if os.path.exists(self.token_path):
+            try:
+                return Credentials.from_authorized_user_file(self.token_path, self.scopes)
+            except ValueError as error:  # Including JSONDecodeError
+                print(f"Stored Gmail token {self.token_path} can't be read, authorizing again: {error}")
+                return None
+        legacy_path = os.path.join(os.path.dirname(self.token_path), LEGACY_TOKEN_FILE)
+        if os.path.exists(legacy_path):
+            # A file we wrote ourselves; it is never read again once converted
+            with open(legacy_path, "rb") as token:
+                creds = pickle.load(token)
+            _write_token(creds, self.token_path)
+            os.remove(legacy_path)
+            return creds
+        return None
+
+    def _refresh(self, creds):
+        """Refresh an expired access token; return False if that isn't possible."""
+        from google.auth.exceptions import RefreshError
+        from google.auth.transport.requests import Request
+
+        try:
+            creds.refresh(Request())
+        except RefreshError as error:
+            print(f"Stored Gmail authorization can't be refreshed: {error}")
+            return False
+        return True
+
+    def _authorize(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets, self.scopes)
+        return flow.run_local_server(port=0)
+
+    def get_credentials(self):
+        """Return valid credentials, refreshing or authorizing as needed."""
+        with self.lock:
+            creds = self.creds or self._load()
+            if creds and creds.valid:
+                self.creds = creds
+                return creds
+            if not (creds and creds.refresh_token and self._refresh(creds)):
+                creds = self._authorize()
+            _write_token(creds, self.token_path)
+            self.creds = creds
+            return creds
+
+
+class SessionPool:
+    """A small pool of authorized HTTP sessions for concurrent Gmail calls.
+
+    httplib2 connections aren't thread-safe, so each caller borrows a session
+    of its own with session(). Sessions keep their connection alive between
+    calls and refresh the shared credentials when they expire. Sessions are
+    created on first use, up to size.
+    """
+
+    def __init__(self, credentials, size=SESSION_POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()  # Most recently used first, so its connection is warm
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _new_session(self):
+        import google_auth_httplib2
+        import httplib2
+
+        return google_auth_httplib2.AuthorizedHttp(
+            self.credentials, http=httplib2.Http(timeout=self.timeout)
+        )
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the body: `with pool.session() as http:`."""
+        try:
+            http = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if not create:
+                http = self.idle.get()
+            else:
+                try:
+                    http = self._new_session()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+        try:
+            yield http
+        finally:
+            self.idle.put(http)
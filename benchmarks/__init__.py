@@ -0,0 +1,23 @@
+"""Benchmarks for the extraction pipeline.
+
+synthetic builds PO emails shaped like the Wayfair template, fake_gmail
+serves them through an in-process stand-in for the Gmail API, and run
+measures throughput and peak memory:
+
+    python -m benchmarks.run --messages 2000 --items 10
+
+differential checks that the template fast path extracts exactly what the
+BeautifulSoup extractors do:
+
+    python -m benchmarks.differential --archive archive.db
+
+incremental checks Gmail listing through the history endpoint, the
+fallback to a full scan, the watermark kept by failed listings and the
+retries of failed messages:
+
+    python -m benchmarks.incremental
+
+startup measures the cold start of the GUI and CLI:
+
+    python -m benchmarks.startup
+"""
@@ -0,0 +1,127 @@
+"""Check that the template fast path extracts exactly what BeautifulSoup does.
+
+Runs both extractors over synthetic emails, including randomly mutated ones
+that the fast path has to reject, and optionally over every email in the
+local archive. A case passes when extract_data_from_html gives the same
+records (or raises the same error) with and without the fast path. Exits
+with status 1 on any mismatch.
+
+    python -m benchmarks.differential --messages 2000 --archive archive.db
+"""
+
+import argparse
+import random
+import sys
+import time
+from archive import EmailArchive
+from benchmarks.synthetic import make_customers, make_po_emails, make_po_html
+from extract import extract_data_from_html
+from template import extract_with_template
+
+
+def _replace_nth(html, old, new, rng):
+    """Replace a random occurrence of old in html."""
+    count = html.count(old)
+    if not count:
+        return html
+    start = -1
+    for _ in range(rng.randrange(count) + 1):
+        start = html.index(old, start + 1)
+    return html[:start] + new + html[start + len(old):]
+
+
+# Edits that real emails could plausibly contain, or that break the layout
+MUTATIONS = [
+    lambda html, rng: _replace_nth(html, "</h5>", "<!-- note --></h5>", rng),
+    lambda html, rng: _replace_nth(html, "<h5", "<h5><span>x</span></h5><h5", rng),
+    lambda html, rng: _replace_nth(html, "<td", "<td><h5></h5></td><td", rng),
+    lambda html, rng: _replace_nth(html, "</td>", "", rng),
+    lambda html, rng: _replace_nth(html, "<tr>", "<tr><td>extra</td>", rng),
+    lambda html, rng: _replace_nth(html, "<tbody>", "", rng),
+    lambda html, rng: _replace_nth(html, ">", ">\n   ", rng),
+    lambda html, rng: _replace_nth(html, "Customer<", "Client<", rng),
+    lambda html, rng: _replace_nth(html, "Ship To", "Deliver To", rng),
+    lambda html, rng: _replace_nth(html, "Sold On", "PO Number", rng),
+    lambda html, rng: _replace_nth(html, "$", "USD ", rng),
+    lambda html, rng: _replace_nth(html, "@", " at ", rng),
+    lambda html, rng: _replace_nth(html, "Accent", "Café  Chair  ✓", rng),
+    lambda html, rng: _replace_nth(html, "</tr>", "</tr><tr></tr>", rng),
+    lambda html, rng: _replace_nth(html, "<table", "<table><tbody><tr><td></td></tr></tbody></table><table", rng),
+    lambda html, rng: html[: rng.randrange(len(html))],
+]
+
+
+def synthetic_cases(count, seed):
+    """Yield (name, html) for plain, repeated-item and mutated synthetic emails."""
+    rng = random.Random(seed)
+    for po_number, html in make_po_emails(count, items_per_email=4, seed=seed):
+        yield po_number, html
+        yield f"{po_number} (bytes)", html.encode()
+        mutated = html
+        for _ in range(rng.randint(1, 3)):
+            mutated = rng.choice(MUTATIONS)(mutated, rng)
+        yield f"{po_number} (mutated)", mutated
+    customer = make_customers(1, seed)[0]
+    items = [(2, "A100", "Lamp   A100", "$10.00"), (1, "B200", "Rug", "$5.50"),
+             (3, "A100", "Lamp A100", "$1,010.00")]
+    yield "repeated item codes", make_po_html("CS999999", customer, items)
+
+
+def archive_cases(path):
+    with EmailArchive(path) as archive:
+        for msg_id, html_parts in archive.iter_messages():
+            for part, html in enumerate(html_parts):
+                yield f"{msg_id}/{part}", html
+
+
+def _outcome(html, fast_path):
+    try:
+        return extract_data_from_html(html, fast_path=fast_path)
+    except Exception as error:
+        return f"{type(error).__name__}: {error}"
+
+
+def compare(cases):
+    """Return (checked, fast, mismatches, fast_seconds, slow_seconds) over cases."""
+    checked = fast = 0
+    mismatches = []
+    fast_seconds = slow_seconds = 0.0
+    for name, html in cases:
+        checked += 1
+        started = time.perf_counter()
+        expected = _outcome(html, fast_path=False)
+        slow_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        actual = _outcome(html, fast_path=True)
+        fast_seconds += time.perf_counter() - started
+        if extract_with_template(html) is not None:
+            fast += 1
+        if actual != expected:
+            mismatches.append((name, expected, actual))
+    return checked, fast, mismatches, fast_seconds, slow_seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the fast path with the BeautifulSoup extractors")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--archive", help="also check every email in this archive.db")
+    args = parser.parse_args(argv)
+
+    cases = list(synthetic_cases(args.messages, args.seed))
+    if args.archive:
+        cases.extend(archive_cases(args.archive))
+    checked, fast, mismatches, fast_seconds, slow_seconds = compare(cases)
+
+    print(f"{checked} emails checked, {fast} on the fast path, {checked - fast} fell back")
+    print(f"BeautifulSoup {slow_seconds:.2f}s, with fast path {fast_seconds:.2f}s")
+    for name, expected, actual in mismatches[:10]:
+        print(f"MISMATCH {name}\n  expected {expected!r}\n  actual   {actual!r}")
+    if mismatches:
+        print(f"{len(mismatches)} mismatches")
+        sys.exit(1)
+    print("All outputs identical.")
+
+
+if __name__ == "__main__":
+    main()
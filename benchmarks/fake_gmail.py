@@ -0,0 +1,206 @@
+import copy
+import time
+from googleapiclient.errors import HttpError
+
+
+class HttpResponse(dict):
+    """Minimal httplib2.Response stand-in for building HttpError."""
+
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+        self.reason = "Fake error"
+
+
+class FakeRequest:
+    """A deferred call, like googleapiclient's HttpRequest."""
+
+    def __init__(self, service, handler):
+        self.service = service
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        self.service.requests += 1
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        return self.handler()
+
+
+class FakeBatch:
+    """Runs its requests in one simulated round trip, like BatchHttpRequest."""
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback))
+
+    def execute(self, http=None):
+        self.service.batches += 1
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.handler(), None
+            except Exception as error:
+                response, exception = None, error
+            (callback or self.callback)(request_id, response, exception)
+
+
+class FakeGmailService:
+    """In-process stand-in for the parts of the Gmail API the pipeline uses.
+
+    Supports users().messages().list/get, users().messages().attachments().get,
+    users().getProfile, users().history().list and new_batch_http_request. latency adds a sleep
+    per HTTP round trip (a single request or a whole batch), inject_errors
+    makes gets fail, e.g. with 429 rate limits, and inject_list_errors does
+    the same for messages.list.
+
+    Usage:
+        service = FakeGmailService(latency=0.05)
+        service.add_message("m1", make_gmail_message("m1", html))
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.mailbox = {}  # msg_id -> message, newest last
+        self.attachments = {}  # (msg_id, attachment_id) -> base64url data
+        self.history_records = []  # (history_id, msg_id)
+        self.history_id = 1
+        self.oldest_history_id = 1
+        self.requests = 0
+        self.batches = 0
+        self.injected_errors = []  # HTTP statuses for the next messages.get calls
+        self.injected_list_errors = []  # HTTP statuses for the next messages.list calls
+
+    def add_message(self, msg_id, message, attachments=None):
+        """Deliver a message, with attachment bodies keyed by attachment ID."""
+        self.history_id += 1
+        self.mailbox[msg_id] = message
+        for attachment_id, data in (attachments or {}).items():
+            self.attachments[msg_id, attachment_id] = data
+        self.history_records.append((self.history_id, msg_id))
+
+    def inject_errors(self, count, status=429):
+        """Make the next count messages.get calls fail with an HTTP status."""
+        self.injected_errors.extend([status] * count)
+
+    def inject_list_errors(self, count, status=403):
+        """Make the next count messages.list calls fail with an HTTP status."""
+        self.injected_list_errors.extend([status] * count)
+
+    def expire_history(self):
+        """Drop the history records, as Gmail does after about a week."""
+        self.history_records = []
+        self.oldest_history_id = self.history_id
+
+    # Resource tree
+    def users(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def getProfile(self, userId):
+        return FakeRequest(self, lambda: {"historyId": str(self.history_id)})
+
+    def messages(self):
+        return _Messages(self)
+
+    def history(self):
+        return _History(self)
+
+    def _subject(self, message):
+        headers = message["payload"].get("headers", [])
+        return next((h["value"] for h in headers if h["name"] == "Subject"), "")
+
+
+class _Messages:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None, **kwargs):
+        def handler():
+            if self.service.injected_list_errors:
+                status = self.service.injected_list_errors.pop(0)
+                raise HttpError(HttpResponse(status), b"Injected error")
+            ids = [
+                msg_id
+                for msg_id, message in reversed(self.service.mailbox.items())
+                if not q or _matches(q, self.service._subject(message))
+            ]
+            start = int(pageToken or 0)
+            page = ids[start : start + maxResults]
+            response = {"resultSizeEstimate": len(page)}
+            if page:
+                response["messages"] = [{"id": msg_id, "threadId": msg_id} for msg_id in page]
+            if start + maxResults < len(ids):
+                response["nextPageToken"] = str(start + maxResults)
+            return response
+
+        return FakeRequest(self.service, handler)
+
+    def get(self, userId, id, format="full", metadataHeaders=None, **kwargs):
+        def handler():
+            if self.service.injected_errors:
+                status = self.service.injected_errors.pop(0)
+                raise HttpError(HttpResponse(status), b"Injected error")
+            if id not in self.service.mailbox:
+                raise HttpError(HttpResponse(404), b"Not Found")
+            message = copy.deepcopy(self.service.mailbox[id])
+            if format == "metadata":
+                payload = message["payload"]
+                message["payload"] = {
+                    "mimeType": payload["mimeType"],
+                    "headers": [
+                        h for h in payload.get("headers", [])
+                        if not metadataHeaders or h["name"] in metadataHeaders
+                    ],
+                }
+            return message
+
+        return FakeRequest(self.service, handler)
+
+    def attachments(self):
+        return _Attachments(self.service)
+
+
+class _Attachments:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, userId, messageId, id, **kwargs):
+        def handler():
+            data = self.service.attachments.get((messageId, id))
+            if data is None:
+                raise HttpError(HttpResponse(404), b"Not Found")
+            return {"attachmentId": id, "size": len(data), "data": data}
+
+        return FakeRequest(self.service, handler)
+
+
+class _History:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, startHistoryId, historyTypes=None, pageToken=None, **kwargs):
+        def handler():
+            if int(startHistoryId) < self.service.oldest_history_id:
+                raise HttpError(HttpResponse(404), b"Requested entity was not found.")
+            records = [
+                {"id": str(history_id), "messagesAdded": [{"message": {"id": msg_id}}]}
+                for history_id, msg_id in self.service.history_records
+                if history_id > int(startHistoryId)
+            ]
+            return {"history": records, "historyId": str(self.service.history_id)}
+
+        return FakeRequest(self.service, handler)
+
+
+def _matches(query, subject):
+    """Evaluate the subject:"..." queries the pipeline sends."""
+    if query.startswith("subject:"):
+        return query[len("subject:"):].strip('"').lower() in subject.lower()
+    return True
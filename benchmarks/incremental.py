@@ -0,0 +1,144 @@
+"""Check incremental Gmail listing against the fake service.
+
+Runs a sequence of ingestions in a scratch directory and checks, after
+each one, which listing path was taken, which messages were processed,
+which history watermark was kept and which failed messages are retried:
+
+- a run whose listing fails records no watermark,
+- the first complete run scans the mailbox and stores the watermark,
+- later runs only read the history added since the watermark,
+- a failed message doesn't hold the watermark back; it is fetched again
+  by the next runs until it has failed MESSAGE_ATTEMPTS times,
+- an expired watermark (HTTP 404) falls back to a full scan, and the
+  watermark stays if that scan fails.
+
+Exits with status 1 if any check fails.
+
+    python -m benchmarks.incremental
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import ingest
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.synthetic import make_gmail_message, make_po_emails
+from sources import GmailSource
+
+BROKEN_HTML = "<html><body><table><tr><td><h5>PO Number</h5></td></tr></table></body></html>"
+
+
+class ListingCounter:
+    """Counts the calls to the full-scan and history listing functions."""
+
+    def __init__(self):
+        self.calls = {"history": 0, "full": 0}
+        self.full_scan = ingest.list_msg_with_title
+        self.since_history = ingest.list_msg_since_history
+        ingest.list_msg_with_title = self._counted("full", self.full_scan)
+        ingest.list_msg_since_history = self._counted("history", self.since_history)
+
+    def _counted(self, name, function):
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    def take(self):
+        """Return the listing path used since the last call, e.g. "history"."""
+        used = [name for name, count in self.calls.items() if count]
+        self.calls = dict.fromkeys(self.calls, 0)
+        return "+".join(used) or "none"
+
+
+def processed_ids():
+    conn = sqlite3.connect("orders.db")
+    ids = {row[0] for row in conn.execute("SELECT message_id FROM processed_emails")}
+    conn.close()
+    return ids
+
+
+def failed_attempts():
+    conn = sqlite3.connect("orders.db")
+    attempts = dict(conn.execute("SELECT message_id, attempts FROM failed_emails"))
+    conn.close()
+    return attempts
+
+
+def run_checks():
+    """Run the scenario; return a list of (check, expected, actual) mismatches."""
+    service = FakeGmailService()
+    emails = make_po_emails(20)
+    counter = ListingCounter()
+    mismatches = []
+
+    def deliver(msg_id, html=None, subject="Action Required: PO"):
+        html = html if html is not None else next(emails)[1]
+        service.add_message(msg_id, make_gmail_message(msg_id, html, subject=subject))
+
+    def run(name, expected_path, expected_ids, expected_watermark, expected_failed=None):
+        stats = ingest.run_ingestion(GmailSource(service=service), archive=False, profile=False)
+        actual = (counter.take(), processed_ids(), ingest.get_history_watermark(), failed_attempts())
+        expected = (expected_path, expected_ids, expected_watermark, expected_failed or {})
+        print(f"{name}: {stats['messages']} listed, {stats['failures']} failed, listing by {actual[0]}")
+        if actual != expected:
+            mismatches.append((name, expected, actual))
+
+    for msg_id in ("m1", "m2", "m3"):
+        deliver(msg_id)
+    deliver("other", subject="Weekly newsletter")
+    service.inject_list_errors(1)
+    run("failed listing", "full", set(), None)
+    run("first run", "full", {"m1", "m2", "m3"}, str(service.history_id))
+
+    deliver("m4")
+    deliver("other2", subject="Weekly newsletter")
+    ids = {"m1", "m2", "m3", "m4"}
+    run("incremental run", "history", ids, str(service.history_id))
+
+    deliver("broken", BROKEN_HTML)
+    deliver("m5")
+    ids.add("m5")
+    run("run with a failure", "history", ids, str(service.history_id), {"broken": 1})
+
+    for attempt in range(2, ingest.MESSAGE_ATTEMPTS + 1):
+        deliver(f"r{attempt}")
+        ids.add(f"r{attempt}")
+        run(f"retry {attempt}", "history", ids, str(service.history_id), {"broken": attempt})
+
+    deliver("m6")
+    ids.add("m6")
+    run("given up", "history", ids, str(service.history_id), {"broken": ingest.MESSAGE_ATTEMPTS})
+
+    watermark = str(service.history_id)
+    service.mailbox["broken"] = make_gmail_message("broken", next(emails)[1])
+    deliver("m7")
+    service.expire_history()
+    service.inject_list_errors(1)
+    run("failed fallback scan", "history+full", ids, watermark, {"broken": ingest.MESSAGE_ATTEMPTS})
+
+    ids.update({"m7", "broken"})
+    run("expired watermark", "history+full", ids, str(service.history_id))
+    return mismatches
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        working_directory = os.getcwd()
+        os.chdir(directory)  # ingest keeps its state in ./orders.db
+        try:
+            mismatches = run_checks()
+        finally:
+            os.chdir(working_directory)
+
+    for name, expected, actual in mismatches:
+        print(f"MISMATCH {name}\n  expected {expected!r}\n  actual   {actual!r}")
+    if mismatches:
+        sys.exit(1)
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    main()
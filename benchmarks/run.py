@@ -0,0 +1,130 @@
+"""Measure messages/sec and peak memory of the pipeline stages.
+
+Every benchmark runs in a fresh temporary directory, so orders.db and
+archive.db in the working tree are never touched. Peak memory is traced in
+a second, untimed pass with tracemalloc and covers Python allocations of
+this process only (not parse pool workers).
+
+    python -m benchmarks.run --messages 1000 --items 8 --customers 200
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.synthetic import make_gmail_message, make_po_emails
+from extract import extract_data_from_html, save_to_database, setup_database
+from export import export_to_excel
+from ingest import run_ingestion
+from sources import GmailSource
+
+
+@contextmanager
+def scratch_directory():
+    """Run the body inside an empty temporary working directory."""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(previous)
+
+
+def measure(setup, run):
+    """Return (seconds, peak_bytes) of run(state), where state = setup().
+
+    setup runs in a fresh scratch directory before each pass and isn't
+    measured.
+    """
+    with scratch_directory():
+        state = setup()
+        started = time.perf_counter()
+        run(state)
+        seconds = time.perf_counter() - started
+
+    with scratch_directory():
+        state = setup()
+        tracemalloc.start()
+        try:
+            run(state)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def report(name, count, seconds, peak):
+    rate = count / seconds if seconds else 0.0
+    print(f"{name:<24} {count:>7} msgs {rate:>10.1f} msgs/s {peak / 2**20:>9.1f} MB peak")
+
+
+def bench_extract(emails, fast_path=True):
+    def run(_):
+        for _, html in emails:
+            extract_data_from_html(html, fast_path=fast_path)
+
+    return measure(lambda: None, run)
+
+
+def bench_save(emails):
+    records = [extract_data_from_html(html) for _, html in emails]
+
+    def run(_):
+        for customer, order, products, order_items in records:
+            save_to_database(customer, order, products, order_items)
+
+    return measure(setup_database, run)
+
+
+def bench_export(emails):
+    records = [extract_data_from_html(html) for _, html in emails]
+
+    def setup():
+        setup_database()
+        for customer, order, products, order_items in records:
+            save_to_database(customer, order, products, order_items)
+
+    return measure(setup, lambda _: export_to_excel())
+
+
+def bench_ingestion(emails, latency):
+    def setup():
+        service = FakeGmailService(latency=latency)
+        for i, (_, html) in enumerate(emails):
+            msg_id = f"m{i:08d}"
+            service.add_message(msg_id, make_gmail_message(msg_id, html))
+        return service
+
+    def run(service):
+        stats = run_ingestion(GmailSource(service=service))
+        assert stats["processed"] == len(emails) and not stats["failures"], stats
+
+    return measure(setup, run)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PO email pipeline")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--items", type=int, default=5, help="line items per email")
+    parser.add_argument("--customers", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="simulated seconds per Gmail round trip"
+    )
+    args = parser.parse_args(argv)
+
+    emails = list(make_po_emails(args.messages, args.items, args.customers, args.seed))
+    count = len(emails)
+    report("extract_data_from_html", count, *bench_extract(emails))
+    report("  BeautifulSoup only", count, *bench_extract(emails, fast_path=False))
+    report("save_to_database", count, *bench_save(emails))
+    report("export_to_excel", count, *bench_export(emails))
+    report("extract_emails (full)", count, *bench_ingestion(emails, args.latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Measure cold start: the time until the GUI or CLI modules are loaded.
+
+Every measurement runs in a fresh interpreter, so nothing is cached in the
+process. Also reports which heavy libraries were imported on the way, which
+should be none of them until they are first needed.
+
+    python -m benchmarks.startup --repeat 5
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Libraries that should only be imported once they are used
+HEAVY_MODULES = [
+    "pyarrow",
+    "bs4",
+    "lxml",
+    "openpyxl",
+    "googleapiclient",
+    "google_auth_oauthlib",
+]
+
+# (name, code run in the fresh interpreter)
+STARTUP_CASES = [
+    ("interpreter", "pass"),
+    ("import main (GUI)", "import main"),
+    ("import cli", "import cli"),
+    ("import + parse one PO", "import extract; extract.extract_data_from_html(HTML)"),
+    (
+        "build Gmail service",
+        "from google.auth.credentials import AnonymousCredentials\n"
+        "from googleapiclient.discovery import build\n"
+        "build('gmail', 'v1', credentials=AnonymousCredentials(),"
+        " static_discovery=True, cache_discovery=False)",
+    ),
+]
+
+SETUP = "from benchmarks.synthetic import make_po_emails\nHTML = next(make_po_emails(1))[1]\n"
+
+
+def time_startup(code, repeat):
+    """Return the wall times of repeat fresh interpreters running code."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def loaded_heavy_modules(code):
+    """Return the HEAVY_MODULES imported by running code in a fresh interpreter."""
+    probe = f"{code}\nimport sys\nprint(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-c", probe], check=True, capture_output=True, text=True
+    )
+    return result.stdout.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark cold start of the GUI and CLI")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    for name, code in STARTUP_CASES:
+        if "HTML" in code:
+            code = SETUP + code
+        times = time_startup(code, args.repeat)
+        heavy = ", ".join(loaded_heavy_modules(code)) or "-"
+        print(
+            f"{name:<24} {statistics.median(times) * 1000:>8.1f} ms median "
+            f"{min(times) * 1000:>8.1f} ms min   heavy: {heavy}"
+        )
+
+
+if __name__ == "__main__":
+    main()
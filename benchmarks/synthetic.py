@@ -0,0 +1,156 @@
+import base64
+import random
+
+# Filler around the data tables, so parsing cost is close to a real email
+STYLE = "<style>" + "td{font-family:Arial;font-size:12px;color:#333}" * 40 + "</style>"
+FOOTER = (
+    "<p>This purchase order is subject to the Wayfair terms and conditions. "
+    "Please confirm the order in Partner Home within 24 hours.</p>" * 8
+)
+
+FIRST_NAMES = ["Ava", "Liam", "Noah", "Emma", "Mia", "Lucas", "Zoe", "Ethan"]
+LAST_NAMES = ["Smith", "Garcia", "Chen", "Patel", "Brown", "Khan", "Muller", "Rossi"]
+STREETS = ["Main St", "Oak Ave", "Pine Rd", "Maple Dr", "Cedar Ln"]
+CITIES = ["Boston, MA 02116", "Austin, TX 73301", "Denver, CO 80014", "Ogden, UT 84401"]
+SHIP_METHODS = ["UPS Ground", "FedEx Home Delivery", "LTL Freight"]
+PRODUCTS = ["Accent Chair", "Dining Table", "Bar Stool", "Area Rug", "Floor Lamp"]
+
+
+def _h5(text):
+    return f'<h5 style="margin:0;font-weight:normal">{text}</h5>'
+
+
+def _row(cells):
+    return "<tr>" + "".join(f'<td valign="top">{cell}</td>' for cell in cells) + "</tr>"
+
+
+def _table(rows):
+    return '<table width="100%" cellpadding="4"><tbody>' + "".join(rows) + "</tbody></table>"
+
+
+def _layout(inner):
+    """Wrap a data table in the nested layout tables the template uses."""
+    return _table([_row([_table([_row([inner])])])])
+
+
+def make_customers(count, seed=0):
+    """Build count distinct customers as (name, street, city, phone, email)."""
+    rng = random.Random(seed)
+    customers = []
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        customers.append((
+            f"{first} {last} {i}",
+            f"{rng.randint(1, 9999)}   {rng.choice(STREETS)}",
+            rng.choice(CITIES),
+            f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(1000, 9999)}",
+            f"{first.lower()}.{last.lower()}{i}@example.com",
+        ))
+    return customers
+
+
+def make_po_html(po_number, customer, items):
+    """Build the HTML body of one PO email.
+
+    customer is a tuple from make_customers and items a list of
+    (quantity, item_code, description, price) tuples.
+    """
+    name, street, city, phone, email = customer
+    order_table = _table([
+        _row([_h5(header) for header in
+              ("PO Number", "Sold On", "Must Ship By", "Ship Method", "Delivery Type", "Payment Method")]),
+        _row([_h5(po_number), _h5("03/05/2025"), _h5("03/12/2025"),
+              _h5(SHIP_METHODS[len(po_number) % len(SHIP_METHODS)]), _h5("Standard"), _h5("Net 30")]),
+    ])
+    customer_table = _table([
+        _row([_h5("Account # / Customer #"), _h5("Customer"), _h5("Ship To")]),
+        _row([_h5("WF-10024"),
+              _h5(name) + _h5(street) + _h5(city) + _h5(""),
+              _h5(name) + _h5(street) + _h5(city) + _h5(phone) + _h5(email)]),
+    ])
+    item_rows = [
+        _row([_h5("Qty"), _h5("Item Code"), _h5("Description"), _h5("Options"), _h5("Unit Cost"), _h5("Total")])
+    ]
+    for quantity, item_code, description, price in items:
+        item_rows.append(_row([
+            _h5(str(quantity)),
+            _h5(item_code) + _h5(f"SKU {item_code.lower()}"),
+            _h5(description),
+            _h5("Color: Gray"),
+            _h5(price),
+            _h5(price),
+        ]))
+    return (
+        f"<html><head>{STYLE}</head><body>"
+        f"{_layout(order_table)}{_layout(customer_table)}{_layout(_table(item_rows))}"
+        f"{FOOTER}</body></html>"
+    )
+
+
+def make_po_emails(count, items_per_email=5, customers=50, seed=0):
+    """Yield (po_number, html) for count synthetic PO emails."""
+    rng = random.Random(seed)
+    customer_list = make_customers(customers, seed)
+    for i in range(count):
+        po_number = f"CS{100000 + i}"
+        items = []
+        for _ in range(items_per_email):
+            code = f"W{rng.randint(1000, 9999)}"
+            product = rng.choice(PRODUCTS)
+            items.append((rng.randint(1, 4), code, f"{product}   {code}",
+                          f"${rng.randint(20, 2000):,}.{rng.randint(0, 99):02d}"))
+        # Each item code appears once per PO, like the real template
+        items = list({item[1]: item for item in items}.values())
+        yield po_number, make_po_html(po_number, rng.choice(customer_list), items)
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def make_gmail_message(msg_id, html, subject="Action Required: PO", history_id=1):
+    """Wrap an HTML body in a Gmail API message resource."""
+    def body(text):
+        return {"size": len(text), "data": _encode(text)}
+
+    return {
+        "id": msg_id,
+        "threadId": msg_id,
+        "historyId": str(history_id),
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [{"name": "Subject", "value": subject}],
+            "parts": [
+                {"partId": "0", "mimeType": "text/plain", "body": body("See the HTML version.")},
+                {"partId": "1", "mimeType": "text/html", "body": body(html)},
+            ],
+        },
+    }
+
+
+def make_gmail_message_with_attachment(
+    msg_id, html, subject="Action Required: PO", history_id=1
+):
+    """Wrap an HTML body as an attached .html file in a multipart/mixed message.
+
+    Gmail leaves the data of such parts out of messages.get, so this returns
+    (message, attachments), to pass on to FakeGmailService.add_message.
+    """
+    message = make_gmail_message(msg_id, "", subject, history_id)
+    alternative = message["payload"]
+    alternative["parts"] = alternative["parts"][:1]  # Just the text/plain part
+    attachment_id = f"att-{msg_id}"
+    message["payload"] = {
+        "mimeType": "multipart/mixed",
+        "headers": alternative.pop("headers"),
+        "parts": [
+            alternative,
+            {
+                "partId": "2",
+                "mimeType": "application/octet-stream",
+                "filename": f"PO-{msg_id}.html",
+                "body": {"size": len(html), "attachmentId": attachment_id},
+            },
+        ],
+    }
+    return message, {attachment_id: _encode(html)}
@@ -0,0 +1,230 @@
+"""Headless ingestion, for cron jobs and servers without a display.
+
+Examples:
+    python cli.py gmail
+    python cli.py gmail --account shop-a --account shop-b
+    python cli.py gmail --batch-size 20
+    python cli.py gmail --early-stop-pages 0
+    python cli.py eml ./exported_emails --workers 8
+    python cli.py --repeated-items separate gmail
+    python cli.py mbox ./orders.mbox
+    python cli.py replay
+    python cli.py export --format csv --output ./exported_data
+    python cli.py export --due-within 7 --ship-method "Small Parcel"
+    python cli.py export --sold-from 2025-03-01 --sold-to 2025-03-31 --customer "Jane Doe"
+    python cli.py report --runs 3
+"""
+
+import argparse
+import time
+from datetime import date
+from extract import REPEATED_ITEMS, REPEATED_ITEMS_MODES, DatabaseWriter, setup_database
+from archive import archived_accounts, replay_archive
+from auth import all_accounts
+from export import EXPORTERS, due_within
+from metrics import format_report
+from ingest import EARLY_STOP_PAGES, run_accounts, run_ingestion
+from sources import EmlDirectorySource, GmailSource, MboxSource
+
+
+def non_negative_int(text):
+    """argparse type for counts where 0 is meaningful."""
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {value}")
+    return value
+
+
+def positive_int(text):
+    """argparse type for counts of at least 1."""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be 1 or more, not {value}")
+    return value
+
+
+def print_stats(stats):
+    """Print the throughput of a finished run."""
+    print(
+        f"Processed {stats['processed']} of {stats['messages']} messages "
+        f"({stats['failures']} failed, {stats['duplicates']} repeated emails not parsed) "
+        f"in {stats['seconds']:.1f}s, "
+        f"{stats['messages_per_second']:.1f} messages/sec."
+    )
+
+
+def print_account_stats(results):
+    """Print the outcome of a run over several accounts, one line each."""
+    for account, stats in results.items():
+        print(f"{account or 'default'}: ", end="")
+        if "error" in stats:
+            print(f"failed, {stats['error']}")
+        else:
+            print_stats(stats)
+
+
+def replay(workers=None, repeated_items=REPEATED_ITEMS):
+    """Re-extract the local archives of all accounts and return run statistics."""
+    setup_database()  # Ensure the database is set up
+    started = time.perf_counter()
+    done = 0
+    failures = 0
+    processed = 0
+
+    def on_progress(msg_id):
+        nonlocal done
+        done += 1
+
+    pipeline_options = {"workers": workers} if workers else {}
+    for account in archived_accounts():
+        with DatabaseWriter(repeated_items=repeated_items, account=account) as writer:
+            failures += len(
+                replay_archive(writer, on_progress=on_progress, account=account, **pipeline_options)
+            )
+        processed += writer.saved
+    seconds = time.perf_counter() - started
+    return {
+        "messages": done,
+        "handled": done,
+        "processed": processed,
+        "failures": failures,
+        "duplicates": 0,  # The archive is always parsed in full
+        "seconds": seconds,
+        "messages_per_second": processed / seconds if seconds else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract Wayfair PO emails into orders.db")
+    parser.add_argument(
+        "--workers", type=int, help="parse in a pool of this many processes"
+    )
+    parser.add_argument(
+        "--no-archive", action="store_true", help="don't store fetched HTML in archive.db"
+    )
+    parser.add_argument(
+        "--no-profile", action="store_true", help="don't record per-stage timings"
+    )
+    parser.add_argument(
+        "--repeated-items",
+        choices=REPEATED_ITEMS_MODES,
+        default=REPEATED_ITEMS,
+        help="add up PO lines repeating an item code, or keep them as separate lines",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    gmail_parser = subparsers.add_parser(
+        "gmail", help="read the Gmail mailboxes (credentials.json, accounts/*/token.json)"
+    )
+    gmail_parser.add_argument(
+        "--account",
+        action="append",
+        help='only read this account (repeatable, "" is the default one); all of them by default',
+    )
+    gmail_parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="at most this many message downloads in flight per batch request (default 50)",
+    )
+    gmail_parser.add_argument(
+        "--early-stop-pages",
+        type=non_negative_int,
+        default=EARLY_STOP_PAGES,
+        metavar="PAGES",
+        help="stop a full scan after this many fully processed pages in a row; 0 scans everything "
+        f"(default {EARLY_STOP_PAGES})",
+    )
+    eml_parser = subparsers.add_parser("eml", help="read a directory of .eml files")
+    eml_parser.add_argument("directory")
+    mbox_parser = subparsers.add_parser("mbox", help="read an mbox file")
+    mbox_parser.add_argument("path")
+    subparsers.add_parser("replay", help="re-extract the local archive, offline")
+    export_parser = subparsers.add_parser("export", help="export the database tables")
+    export_parser.add_argument("--format", choices=sorted(EXPORTERS), default="xlsx")
+    export_parser.add_argument(
+        "--output", help="workbook path for xlsx, directory for csv and parquet"
+    )
+    for option, help_text in [
+        ("--sold-from", "only orders sold on or after this date (YYYY-MM-DD)"),
+        ("--sold-to", "only orders sold on or before this date"),
+        ("--ship-by-from", "only orders to ship by this date or later"),
+        ("--ship-by-to", "only orders to ship by this date or earlier"),
+    ]:
+        export_parser.add_argument(option, type=date.fromisoformat, help=help_text)
+    export_parser.add_argument(
+        "--due-within", type=positive_int, metavar="DAYS", help="only orders that must ship in the next DAYS days"
+    )
+    export_parser.add_argument("--customer", help="only the orders of this customer")
+    export_parser.add_argument("--ship-method", help="only orders with this ship method")
+    report_parser = subparsers.add_parser("report", help="compare the stage timings of recent runs")
+    report_parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        setup_database()  # Ensure the database is set up
+        print(format_report(args.runs))
+        return
+
+    if args.command == "export":
+        exporter = EXPORTERS[args.format]
+        filters = {
+            "sold_from": args.sold_from,
+            "sold_to": args.sold_to,
+            "ship_by_from": args.ship_by_from,
+            "ship_by_to": args.ship_by_to,
+            "customer": args.customer,
+            "ship_method": args.ship_method,
+        }
+        if args.due_within is not None:
+            filters.update(due_within(args.due_within))
+        setup_database()  # Ensure dates are normalized and indexed
+        if args.output:
+            exporter(args.output, **filters)
+        else:
+            exporter(**filters)
+        return
+
+    if args.command == "replay":
+        print_stats(replay(args.workers, args.repeated_items))
+        return
+
+    if args.command == "gmail":
+        accounts = args.account or all_accounts() or [""]
+        if len(accounts) > 1:
+            results = run_accounts(
+                [
+                    GmailSource(
+                        account=account,
+                        max_batch_size=args.batch_size,
+                        stop_after_processed_pages=args.early_stop_pages,
+                    )
+                    for account in accounts
+                ],
+                archive=not args.no_archive,
+                workers=args.workers,
+                profile=not args.no_profile,
+                repeated_items=args.repeated_items,
+            )
+            print_account_stats(results)
+            return
+        source = GmailSource(
+            account=accounts[0],
+            max_batch_size=args.batch_size,
+            stop_after_processed_pages=args.early_stop_pages,
+        )
+    elif args.command == "eml":
+        source = EmlDirectorySource(args.directory)
+    else:
+        source = MboxSource(args.path)
+
+    stats = run_ingestion(
+        source,
+        archive=not args.no_archive,
+        workers=args.workers,
+        profile=not args.no_profile,
+        repeated_items=args.repeated_items,
+    )
+    print_stats(stats)
+
+
+if __name__ == "__main__":
+    main()
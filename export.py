@@ -0,0 +1,189 @@
+import csv
+import os
+import sqlite3
+from datetime import date, timedelta
+
+EXPORT_CHUNK_SIZE = 5000  # Rows fetched from the cursor at a time
+
+# Per-customer order count and total quantity, kept current by triggers
+CUSTOMERS_EXPORT_QUERY = """
+    SELECT c.name, c.address, c.phone_number, c.email_address,
+           totals.orders_count, totals.total_product_quantity
+    FROM customers c
+    LEFT JOIN customer_totals totals ON totals.customer_name = c.name
+"""
+
+# (sheet name, file name, query) for every exported table
+EXPORT_TABLES = [
+    ("Customers", "customers", CUSTOMERS_EXPORT_QUERY),
+    ("Products", "products", "SELECT * FROM products"),
+    ("Orders", "orders", "SELECT * FROM orders"),
+    ("Order Items", "order_items", "SELECT * FROM order_items"),
+]
+
+# Filter keyword -> condition on orders (alias o). Dates are ISO strings or
+# datetime.date objects and ranges include both ends. Each condition is
+# served by an index range scan (see extract.setup_database).
+ORDER_FILTERS = {
+    "sold_from": "o.sold_on >= ?",
+    "sold_to": "o.sold_on <= ?",
+    "ship_by_from": "o.must_ship_by >= ?",
+    "ship_by_to": "o.must_ship_by <= ?",
+    "customer": "o.customer_name = ?",
+    "ship_method": "o.ship_method = ?",
+}
+
+# The same tables, limited to the orders matching {conditions}: their
+# customers, the products on them and their line items
+FILTERED_EXPORT_TABLES = [
+    ("Customers", "customers", CUSTOMERS_EXPORT_QUERY
+     + " WHERE c.name IN (SELECT o.customer_name FROM orders o WHERE {conditions})"),
+    ("Products", "products", """
+        SELECT * FROM products WHERE item_code IN (
+            SELECT i.product_item_code FROM orders o
+            JOIN order_items i ON i.order_po_number = o.po_number
+            WHERE {conditions})"""),
+    ("Orders", "orders", "SELECT o.* FROM orders o WHERE {conditions}"),
+    ("Order Items", "order_items", """
+        SELECT i.* FROM orders o
+        JOIN order_items i ON i.order_po_number = o.po_number
+        WHERE {conditions}"""),
+]
+
+# Parquet column types; every other column is exported as a string
+PARQUET_TYPES = {
+    "orders_count": "int64",
+    "total_product_quantity": "int64",
+    "quantity": "int64",
+    "line_number": "int64",
+    "price": "float64",
+}
+
+
+def order_conditions(filters):
+    """Return (SQL condition, parameters) selecting the orders that match filters.
+
+    filters maps ORDER_FILTERS keywords to values; None values are ignored.
+    """
+    unknown = set(filters) - set(ORDER_FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown order filters {sorted(unknown)}, expected some of {list(ORDER_FILTERS)}")
+    conditions, params = [], []
+    for name, value in filters.items():
+        if value is None:
+            continue
+        conditions.append(ORDER_FILTERS[name])
+        params.append(value.isoformat() if isinstance(value, date) else value)
+    return " AND ".join(conditions) or "1", params
+
+
+def due_within(days, today=None):
+    """Filters for the orders that must ship in the next days days, today included."""
+    if days < 1:
+        raise ValueError(f"days must be at least 1, not {days}")
+    today = today or date.today()
+    return {"ship_by_from": today, "ship_by_to": today + timedelta(days=days - 1)}
+
+
+def query_orders(conn, **filters):
+    """Return a cursor over the orders matching filters (see ORDER_FILTERS)."""
+    conditions, params = order_conditions(filters)
+    return conn.execute(f"SELECT o.* FROM orders o WHERE {conditions}", params)
+
+
+def iter_export_tables(conn, chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Yield (sheet_name, file_name, columns, chunks) for every exported table.
+
+    chunks lazily yields lists of up to chunk_size rows, so a table is never
+    held in memory as a whole. With filters (see ORDER_FILTERS) only the
+    matching orders are exported, with their customers, products and items.
+    """
+    filters = {name: value for name, value in filters.items() if value is not None}
+    if filters:
+        conditions, params = order_conditions(filters)
+        tables = [
+            (sheet_name, file_name, query.format(conditions=conditions), params)
+            for sheet_name, file_name, query in FILTERED_EXPORT_TABLES
+        ]
+    else:
+        tables = [(sheet_name, file_name, query, []) for sheet_name, file_name, query in EXPORT_TABLES]
+    for sheet_name, file_name, query, params in tables:
+        cursor = conn.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
+        yield sheet_name, file_name, columns, chunks
+
+
+def export_to_excel(path="exported_data.xlsx", db_path="orders.db", chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Export the tables to one Excel workbook, one sheet per table.
+
+    filters (see ORDER_FILTERS) limit the export to the matching orders.
+    """
+    from openpyxl import Workbook  # Slow to import, so only loaded when exporting
+
+    conn = sqlite3.connect(db_path)
+    workbook = Workbook(write_only=True)  # Rows are streamed to disk
+    try:
+        for sheet_name, _, columns, chunks in iter_export_tables(conn, chunk_size, **filters):
+            sheet = workbook.create_sheet(title=sheet_name)
+            sheet.append(columns)
+            for rows in chunks:
+                for row in rows:
+                    sheet.append(row)
+        workbook.save(path)
+    finally:
+        conn.close()
+
+
+def export_to_csv(directory="exported_data", db_path="orders.db", chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Export the tables to one CSV file per table in directory; filters as for export_to_excel."""
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    try:
+        for _, file_name, columns, chunks in iter_export_tables(conn, chunk_size, **filters):
+            path = os.path.join(directory, f"{file_name}.csv")
+            with open(path, "w", newline="", encoding="utf-8") as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(columns)
+                for rows in chunks:
+                    writer.writerows(rows)
+    finally:
+        conn.close()
+
+
+def export_to_parquet(directory="exported_data", db_path="orders.db", chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """Export the tables to one Parquet file per table in directory; filters
+    as for export_to_excel.
+
+    Needs pyarrow, from the optional "parquet" extra.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet export needs pyarrow: pip install '.[parquet]'") from None
+
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    try:
+        for _, file_name, columns, chunks in iter_export_tables(conn, chunk_size, **filters):
+            schema = pa.schema(
+                [(column, PARQUET_TYPES.get(column, "string")) for column in columns]
+            )
+            path = os.path.join(directory, f"{file_name}.parquet")
+            with pq.ParquetWriter(path, schema) as writer:
+                for rows in chunks:
+                    writer.write_batch(
+                        pa.record_batch(
+                            [list(column) for column in zip(*rows)], schema=schema
+                        )
+                    )
+    finally:
+        conn.close()
+
+
+EXPORTERS = {
+    "xlsx": export_to_excel,
+    "csv": export_to_csv,
+    "parquet": export_to_parquet,
+}
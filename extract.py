@@ -1,7 +1,24 @@
+import hashlib
 import sqlite3
-import pandas as pd
-from bs4 import BeautifulSoup
 import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from importlib.util import find_spec
+import metrics
+
+# Checked without importing lxml, which is only loaded once parsing starts
+HTML_PARSER = "lxml" if find_spec("lxml") else "html.parser"
+
+# Header texts that mark the tables the extractors read from
+ORDER_ANCHOR = "PO Number"
+CUSTOMER_ANCHOR = "Account # / Customer #"
+PRODUCTS_ANCHOR = "Item Code"
+ANCHORS = (ORDER_ANCHOR, CUSTOMER_ANCHOR, PRODUCTS_ANCHOR)
+
+# Date formats seen in the PO emails, tried in order by normalize_date
+DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%Y-%m-%d", "%b %d, %Y", "%B %d, %Y")
 
 # Database setup
 def setup_database():
@@ -36,61 +53,414 @@ def setup_database():
         product_item_code TEXT,
         quantity INTEGER,
         price REAL,
-        PRIMARY KEY (order_po_number, product_item_code),
+        line_number INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (order_po_number, product_item_code, line_number),
         FOREIGN KEY (order_po_number) REFERENCES orders(po_number),
         FOREIGN KEY (product_item_code) REFERENCES products(item_code)
     )''')
     
-    # New table to track processed emails
+    # New table to track processed emails; message IDs are only unique
+    # within one mailbox, so they are keyed by account ("" is the default one)
     cursor.execute('''CREATE TABLE IF NOT EXISTS processed_emails (
-        message_id TEXT PRIMARY KEY,
-        processed_at TEXT
+        account TEXT NOT NULL DEFAULT '',
+        message_id TEXT,
+        processed_at TEXT,
+        PRIMARY KEY (account, message_id)
     )''')
     
-    # New table to log extraction calls
+    # New table to log extraction calls, one row per account and run
     cursor.execute('''CREATE TABLE IF NOT EXISTS extraction_logs (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TEXT
+        timestamp TEXT,
+        history_id TEXT,
+        account TEXT NOT NULL DEFAULT '',
+        messages INTEGER,
+        processed INTEGER,
+        seconds REAL
     )''')
     
+    # Per-stage timings of each extraction run (see metrics.py)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS extraction_metrics (
+        log_id INTEGER,
+        stage TEXT,
+        calls INTEGER,
+        total_seconds REAL,
+        p50_seconds REAL,
+        p95_seconds REAL,
+        max_seconds REAL,
+        failures INTEGER,
+        PRIMARY KEY (log_id, stage),
+        FOREIGN KEY (log_id) REFERENCES extraction_logs(id)
+    )''')
+    
+    # Hashes of the email content already ingested, to skip repeated POs
+    cursor.execute('''CREATE TABLE IF NOT EXISTS content_fingerprints (
+        fingerprint TEXT PRIMARY KEY,
+        po_number TEXT,
+        message_id TEXT,
+        ingested_at TEXT
+    )''')
+    
+    # Messages that failed to be fetched, parsed or saved, with the number of
+    # runs they failed in; Gmail runs fetch them again (see ingest.list_new_messages)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS failed_emails (
+        account TEXT NOT NULL DEFAULT '',
+        message_id TEXT,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        error TEXT,
+        failed_at TEXT,
+        PRIMARY KEY (account, message_id)
+    )''')
+    
+    # Databases created before incremental sync lack the watermark column
+    cursor.execute("PRAGMA table_info(extraction_logs)")
+    log_columns = {row[1] for row in cursor.fetchall()}
+    if "history_id" not in log_columns:
+        cursor.execute("ALTER TABLE extraction_logs ADD COLUMN history_id TEXT")
+    
+    # Nor do the ones from before multi-account ingestion have the account
+    # columns and run statistics
+    for column, column_type in EXTRACTION_LOG_COLUMNS:
+        if column not in log_columns:
+            cursor.execute(f"ALTER TABLE extraction_logs ADD COLUMN {column} {column_type}")
+    cursor.execute("PRAGMA table_info(processed_emails)")
+    if "account" not in {row[1] for row in cursor.fetchall()}:
+        cursor.executescript(PROCESSED_EMAILS_MIGRATION)
+    
+    # A failed message that is processed at last isn't retried any more;
+    # created after the migration, which drops the triggers of the old table
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS processed_emails_clear_failure
+        AFTER INSERT ON processed_emails BEGIN
+        DELETE FROM failed_emails WHERE account = new.account AND message_id = new.message_id;
+    END''')
+    
+    # Databases created before repeated line items were kept apart have no
+    # line_number in the order_items key; SQLite can only add it by copying
+    cursor.execute("PRAGMA table_info(order_items)")
+    if "line_number" not in {row[1] for row in cursor.fetchall()}:
+        cursor.executescript(ORDER_ITEMS_MIGRATION)
+    
+    # Databases created before dates were normalized hold them as scraped;
+    # the must_ship_by index is created together with the conversion
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'orders_must_ship_by'")
+    if cursor.fetchone() is None:
+        migrate_order_dates(cursor)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS orders_customer_name ON orders (customer_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS order_items_product ON order_items (product_item_code)")
+    # Range scans for the filtered exports (see export.order_conditions)
+    cursor.execute("CREATE INDEX IF NOT EXISTS orders_sold_on ON orders (sold_on)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS orders_must_ship_by ON orders (must_ship_by)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS orders_ship_method ON orders (ship_method, must_ship_by)")
+    
+    # Summary tables kept current by triggers; filled from the existing rows
+    # the first time they are created
+    cursor.execute("""SELECT COUNT(*) FROM sqlite_master
+                      WHERE type = 'table' AND name IN ('customer_totals', 'account_totals')""")
+    summaries_exist = cursor.fetchone()[0] == 2
+    cursor.executescript(SUMMARY_SCHEMA)
+    if not summaries_exist:
+        rebuild_summaries(cursor)
+    
     conn.commit()
     conn.close()
 
 
+ORDER_ITEMS_MIGRATION = '''
+BEGIN;
+-- Triggers reading order_items would block the rename; SUMMARY_SCHEMA recreates them
+DROP TRIGGER IF EXISTS orders_after_insert;
+DROP TRIGGER IF EXISTS orders_after_update_customer;
+DROP TRIGGER IF EXISTS orders_after_delete;
+CREATE TABLE order_items_new (
+    order_po_number TEXT,
+    product_item_code TEXT,
+    quantity INTEGER,
+    price REAL,
+    line_number INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (order_po_number, product_item_code, line_number),
+    FOREIGN KEY (order_po_number) REFERENCES orders(po_number),
+    FOREIGN KEY (product_item_code) REFERENCES products(item_code)
+);
+INSERT INTO order_items_new (order_po_number, product_item_code, quantity, price)
+    SELECT order_po_number, product_item_code, quantity, price FROM order_items;
+DROP TABLE order_items;
+ALTER TABLE order_items_new RENAME TO order_items;
+COMMIT;
+'''
+
+
+EXTRACTION_LOG_COLUMNS = [
+    ("account", "TEXT NOT NULL DEFAULT ''"),
+    ("messages", "INTEGER"),
+    ("processed", "INTEGER"),
+    ("seconds", "REAL"),
+]
+
+# Dropping the old table drops its triggers too; SUMMARY_SCHEMA recreates them
+PROCESSED_EMAILS_MIGRATION = '''
+BEGIN;
+CREATE TABLE processed_emails_new (
+    account TEXT NOT NULL DEFAULT '',
+    message_id TEXT,
+    processed_at TEXT,
+    PRIMARY KEY (account, message_id)
+);
+INSERT INTO processed_emails_new (message_id, processed_at)
+    SELECT message_id, processed_at FROM processed_emails;
+DROP TABLE processed_emails;
+ALTER TABLE processed_emails_new RENAME TO processed_emails;
+COMMIT;
+'''
+
+
+# Per-customer totals, per-account processed counts and table row counts,
+# so that exports and the status display don't scan the order tables.
+# Upserts that hit an existing row fire the UPDATE triggers, not the
+# INSERT ones.
+SUMMARY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS customer_totals (
+    customer_name TEXT PRIMARY KEY,
+    orders_count INTEGER NOT NULL DEFAULT 0,
+    total_product_quantity INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS table_counts (
+    table_name TEXT PRIMARY KEY,
+    row_count INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO table_counts (table_name) VALUES ('customers'), ('orders'), ('processed_emails');
+
+CREATE TABLE IF NOT EXISTS account_totals (
+    account TEXT PRIMARY KEY,
+    processed_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS orders_after_insert AFTER INSERT ON orders BEGIN
+    INSERT INTO customer_totals (customer_name, orders_count, total_product_quantity)
+    VALUES (new.customer_name, 1, (SELECT COALESCE(SUM(quantity), 0) FROM order_items
+                                   WHERE order_po_number = new.po_number))
+    ON CONFLICT(customer_name) DO UPDATE SET
+        orders_count = orders_count + 1,
+        total_product_quantity = total_product_quantity + excluded.total_product_quantity;
+    UPDATE table_counts SET row_count = row_count + 1 WHERE table_name = 'orders';
+END;
+
+-- A re-sent PO may name a different customer: move the order's totals over
+CREATE TRIGGER IF NOT EXISTS orders_after_update_customer AFTER UPDATE OF customer_name ON orders
+WHEN old.customer_name IS NOT new.customer_name BEGIN
+    UPDATE customer_totals SET
+        orders_count = orders_count - 1,
+        total_product_quantity = total_product_quantity - (
+            SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE order_po_number = old.po_number)
+    WHERE customer_name = old.customer_name;
+    INSERT INTO customer_totals (customer_name, orders_count, total_product_quantity)
+    VALUES (new.customer_name, 1, (SELECT COALESCE(SUM(quantity), 0) FROM order_items
+                                   WHERE order_po_number = new.po_number))
+    ON CONFLICT(customer_name) DO UPDATE SET
+        orders_count = orders_count + 1,
+        total_product_quantity = total_product_quantity + excluded.total_product_quantity;
+END;
+
+CREATE TRIGGER IF NOT EXISTS orders_after_delete AFTER DELETE ON orders BEGIN
+    UPDATE customer_totals SET
+        orders_count = orders_count - 1,
+        total_product_quantity = total_product_quantity - (
+            SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE order_po_number = old.po_number)
+    WHERE customer_name = old.customer_name;
+    UPDATE table_counts SET row_count = row_count - 1 WHERE table_name = 'orders';
+END;
+
+CREATE TRIGGER IF NOT EXISTS order_items_after_insert AFTER INSERT ON order_items BEGIN
+    UPDATE customer_totals SET total_product_quantity = total_product_quantity + COALESCE(new.quantity, 0)
+    WHERE customer_name = (SELECT customer_name FROM orders WHERE po_number = new.order_po_number);
+END;
+
+CREATE TRIGGER IF NOT EXISTS order_items_after_update AFTER UPDATE OF order_po_number, quantity ON order_items BEGIN
+    UPDATE customer_totals SET total_product_quantity = total_product_quantity - COALESCE(old.quantity, 0)
+    WHERE customer_name = (SELECT customer_name FROM orders WHERE po_number = old.order_po_number);
+    UPDATE customer_totals SET total_product_quantity = total_product_quantity + COALESCE(new.quantity, 0)
+    WHERE customer_name = (SELECT customer_name FROM orders WHERE po_number = new.order_po_number);
+END;
+
+CREATE TRIGGER IF NOT EXISTS order_items_after_delete AFTER DELETE ON order_items BEGIN
+    UPDATE customer_totals SET total_product_quantity = total_product_quantity - COALESCE(old.quantity, 0)
+    WHERE customer_name = (SELECT customer_name FROM orders WHERE po_number = old.order_po_number);
+END;
+
+CREATE TRIGGER IF NOT EXISTS customers_after_insert AFTER INSERT ON customers BEGIN
+    UPDATE table_counts SET row_count = row_count + 1 WHERE table_name = 'customers';
+END;
+
+CREATE TRIGGER IF NOT EXISTS customers_after_delete AFTER DELETE ON customers BEGIN
+    UPDATE table_counts SET row_count = row_count - 1 WHERE table_name = 'customers';
+END;
+
+CREATE TRIGGER IF NOT EXISTS processed_emails_after_insert AFTER INSERT ON processed_emails BEGIN
+    UPDATE table_counts SET row_count = row_count + 1 WHERE table_name = 'processed_emails';
+    INSERT INTO account_totals (account, processed_count) VALUES (new.account, 1)
+    ON CONFLICT(account) DO UPDATE SET processed_count = processed_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS processed_emails_after_delete AFTER DELETE ON processed_emails BEGIN
+    UPDATE table_counts SET row_count = row_count - 1 WHERE table_name = 'processed_emails';
+    UPDATE account_totals SET processed_count = processed_count - 1 WHERE account = old.account;
+END;
+'''
+
+
+def migrate_order_dates(cursor):
+    """Convert sold_on and must_ship_by of the stored orders to ISO dates."""
+    cursor.execute("SELECT po_number, sold_on, must_ship_by FROM orders")
+    updates = []
+    for po_number, sold_on, must_ship_by in cursor.fetchall():
+        normalized = (normalize_date(sold_on), normalize_date(must_ship_by))
+        if normalized != (sold_on, must_ship_by):
+            updates.append((*normalized, po_number))
+    cursor.executemany("UPDATE orders SET sold_on = ?, must_ship_by = ? WHERE po_number = ?", updates)
+
+
+def rebuild_summaries(cursor):
+    """Recompute customer_totals, account_totals and table_counts from the tables they sum up."""
+    cursor.execute("DELETE FROM customer_totals")
+    cursor.execute('''INSERT INTO customer_totals (customer_name, orders_count, total_product_quantity)
+                      SELECT o.customer_name, COUNT(*), COALESCE(SUM(items.quantity), 0)
+                      FROM orders o
+                      LEFT JOIN (SELECT order_po_number, SUM(quantity) AS quantity
+                                 FROM order_items GROUP BY order_po_number) items
+                        ON items.order_po_number = o.po_number
+                      GROUP BY o.customer_name''')
+    cursor.execute("DELETE FROM account_totals")
+    cursor.execute('''INSERT INTO account_totals (account, processed_count)
+                      SELECT account, COUNT(*) FROM processed_emails GROUP BY account''')
+    for table_name in ("customers", "orders", "processed_emails"):
+        cursor.execute(
+            f"UPDATE table_counts SET row_count = (SELECT COUNT(*) FROM {table_name}) WHERE table_name = ?",
+            (table_name,),
+        )
+
+
+def read_status(conn):
+    """Return (processed emails, customers, orders, last extraction timestamp)."""
+    counts = dict(conn.execute("SELECT table_name, row_count FROM table_counts"))
+    last_log = conn.execute("SELECT timestamp FROM extraction_logs ORDER BY id DESC LIMIT 1").fetchone()
+    return (counts.get("processed_emails", 0), counts.get("customers", 0),
+            counts.get("orders", 0), last_log[0] if last_log else None)
+
+
+def read_account_status(conn):
+    """
+    Return (account, processed emails, messages/sec, backlog, timestamp)
+    for every account, from account_totals and its extraction_logs. The
+    rate is that of the latest run that saved any email; the backlog is
+    what the latest run listed but didn't save. Both are None for an
+    account that hasn't run yet.
+    """
+    rows = conn.execute('''
+        SELECT a.account, a.processed_count, busy.processed, busy.seconds,
+               latest.messages, latest.processed, latest.timestamp
+        FROM account_totals a
+        LEFT JOIN extraction_logs latest ON latest.id = (
+            SELECT MAX(id) FROM extraction_logs
+            WHERE account = a.account AND messages IS NOT NULL)
+        LEFT JOIN extraction_logs busy ON busy.id = (
+            SELECT MAX(id) FROM extraction_logs
+            WHERE account = a.account AND processed > 0)
+        ORDER BY a.account''').fetchall()
+    status = []
+    for account, processed_count, saved, seconds, messages, processed, timestamp in rows:
+        rate = saved / seconds if seconds else None
+        backlog = messages - processed if messages is not None else None
+        status.append((account, processed_count, rate, backlog, timestamp))
+    return status
+
+
+def _inner_table_for(h5):
+    """Return the table holding h5 if it doesn't contain other tables."""
+    # Navigate up the DOM: h5 -> td -> tr -> tbody -> table
+    td_parent = h5.find_parent('td')
+    if not td_parent:
+        return None
+        
+    tr_parent = td_parent.find_parent('tr')
+    if not tr_parent:
+        return None
+        
+    tbody_parent = tr_parent.find_parent('tbody')
+    if not tbody_parent:
+        return None
+        
+    table_parent = tbody_parent.find_parent('table')
+    if not table_parent:
+        return None
+        
+    # Check if this table doesn't contain other tables
+    if not table_parent.find('table'):
+        return table_parent
+    return None
+
+
 def find_target_table(soup, target_text="PO Number"):
     
     # Find all h5 elements containing the target text
     h5_elements = soup.find_all('h5', string=lambda text: target_text in text if text else False)
     
     for h5 in h5_elements:
-        # Navigate up the DOM: h5 -> td -> tr -> tbody -> table
-        td_parent = h5.find_parent('td')
-        if not td_parent:
-            continue
-            
-        tr_parent = td_parent.find_parent('tr')
-        if not tr_parent:
-            continue
-            
-        tbody_parent = tr_parent.find_parent('tbody')
-        if not tbody_parent:
-            continue
-            
-        table_parent = tbody_parent.find_parent('table')
-        if not table_parent:
-            continue
-            
-        # Check if this table doesn't contain other tables
-        if not table_parent.find('table'):
-            return table_parent
+        table = _inner_table_for(h5)
+        if table is not None:
+            return table
     
     return None
 
 
-def extract_order(soup, customer_name):
+def build_table_index(soup, anchors=ANCHORS):
+    """
+    Map each anchor text to its innermost table in a single pass.
+    
+    Gives the same table find_target_table would return for every anchor,
+    but walks the h5 elements of the document only once.
+    """
+    index = {}
+    pending = list(anchors)
+    
+    for h5 in soup.find_all('h5'):
+        text = h5.string
+        if not text:
+            continue
+        for anchor in [a for a in pending if a in text]:
+            table = _inner_table_for(h5)
+            if table is not None:
+                index[anchor] = table
+                pending.remove(anchor)
+        if not pending:
+            break
+    
+    return index
+
+
+@lru_cache(maxsize=4096)
+def normalize_date(text):
+    """
+    Return a scraped date as an ISO date (YYYY-MM-DD), so that dates sort
+    and compare as text. Text in none of the DATE_FORMATS is returned as it
+    is, and None stays None.
+    """
+    if not text:
+        return text
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            pass
+    return text
+
+
+def extract_order(soup, customer_name, inner_table=None):
     
     # Find the h5 element with "PO Number" and navigate to the inner table
-    inner_table = find_target_table(soup, target_text="PO Number")
+    if inner_table is None:
+        inner_table = find_target_table(soup, target_text=ORDER_ANCHOR)
     # Get all header elements (first row)
     header_row = inner_table.find('tr')
     headers = [h5.get_text().strip() for h5 in header_row.find_all('h5')]
@@ -121,8 +491,8 @@ def extract_order(soup, customer_name):
     
     # Populate the order_data dictionary
     order_data["po_number"] = header_to_value_map.get("PO Number", "")
-    order_data["sold_on"] = header_to_value_map.get("Sold On", "")
-    order_data["must_ship_by"] = header_to_value_map.get("Must Ship By", "")
+    order_data["sold_on"] = normalize_date(header_to_value_map.get("Sold On", ""))
+    order_data["must_ship_by"] = normalize_date(header_to_value_map.get("Must Ship By", ""))
     order_data["ship_method"] = header_to_value_map.get("Ship Method", "")
     order_data["delivery_type"] = header_to_value_map.get("Delivery Type", "")
     order_data["payment_method"] = header_to_value_map.get("Payment Method", "")
@@ -133,9 +503,10 @@ def extract_order(soup, customer_name):
 
 
 
-def extract_customer(soup):
-    # Find the h5 element with "PO Number" and navigate to the inner table
-    inner_table = find_target_table(soup, target_text="Account # / Customer #")
+def extract_customer(soup, inner_table=None):
+    # Find the h5 element with "Account # / Customer #" and navigate to the inner table
+    if inner_table is None:
+        inner_table = find_target_table(soup, target_text=CUSTOMER_ANCHOR)
     # Find the "Customer" column index first
     headers_row = inner_table.find('tr')
     headers = headers_row.find_all('td')
@@ -200,23 +571,29 @@ def extract_customer(soup):
     return customer_data
 
 
-def extract_products_and_order_items(soup, po_number):
+def extract_products_and_order_items(soup, po_number, inner_table=None):
     """
     Extract product and order item information from HTML table.
     
     Args:
         soup (BeautifulSoup): Parsed HTML content holding the table
         po_number (str): Purchase Order Number to include in order items
+        inner_table (Tag, optional): The "Item Code" table, if already located
         
     Returns:
         tuple: (products list, order_items list)
+    
+    Every line of the table becomes an order item. A line repeating an item
+    code gets the next line_number for that code; see merge_repeated_items.
     """
     # Initialize lists
     products = []
     order_items = []
+    lines_per_code = {}  # item code -> lines seen so far
     
     # Find all rows except the header row
-    inner_table = find_target_table(soup, target_text="Item Code")
+    if inner_table is None:
+        inner_table = find_target_table(soup, target_text=PRODUCTS_ANCHOR)
     rows = inner_table.find_all('tr')[1:]
     
     # Extract data from each row
@@ -234,8 +611,9 @@ def extract_products_and_order_items(soup, po_number):
         price_cleaned = float(price.replace('$', '').replace(',', ''))
         
         # Append to products list if not already present
-        product_exists = any(p['item_code'] == item_code for p in products)
-        if not product_exists:
+        line_number = lines_per_code.get(item_code, 0) + 1
+        lines_per_code[item_code] = line_number
+        if line_number == 1:
             products.append({
                 "item_code": item_code,
                 "description": description
@@ -246,84 +624,439 @@ def extract_products_and_order_items(soup, po_number):
             "order_po_number": po_number,
             "product_item_code": item_code,
             "quantity": int(quantity),
-            "price": price_cleaned
+            "price": price_cleaned,
+            "line_number": line_number
         })
     
     return products, order_items
 
 
-def extract_data_from_html(html_content):
-    soup = BeautifulSoup(html_content, "html.parser")
-    customer = extract_customer(soup=soup)
-    order  = extract_order(soup=soup, customer_name=customer["name"])
-    products, order_items = extract_products_and_order_items(soup=soup, po_number=order["po_number"])
+def extract_data_from_html(html_content, parser=HTML_PARSER, fast_path=True):
+    # Emails matching a known template version are read straight from an
+    # lxml tree (see template.py); anything else goes through BeautifulSoup
+    if fast_path and parser == "lxml":
+        from template import extract_with_template
+        
+        records = extract_with_template(html_content)
+        if records is not None:
+            return records
+    
+    from bs4 import BeautifulSoup, SoupStrainer  # Not needed until the first parse
+
+    # Raw bytes go straight to the parser; UTF-8 is tried first since that's
+    # what the PO emails use, with the usual detection as a fallback
+    options = {"from_encoding": "utf-8"} if isinstance(html_content, bytes) else {}
+    # Only the tables are needed, so skip building the rest of the tree
+    soup = BeautifulSoup(html_content, parser, parse_only=SoupStrainer("table"), **options)
+    tables = build_table_index(soup)
+    customer = extract_customer(soup=soup, inner_table=tables.get(CUSTOMER_ANCHOR))
+    order  = extract_order(soup=soup, customer_name=customer["name"], inner_table=tables.get(ORDER_ANCHOR))
+    products, order_items = extract_products_and_order_items(soup=soup, po_number=order["po_number"], inner_table=tables.get(PRODUCTS_ANCHOR))
     return customer, order, products, order_items
 
 
-# Function to save data to SQLite
-def save_to_database(customer, order, products, order_items):
-    conn = sqlite3.connect("orders.db")
-    cursor = conn.cursor()
+_WHITESPACE = re.compile(rb"\s+")
+_BETWEEN_TAGS = re.compile(rb">\s+<")
+
+
+def content_fingerprint(html_parts):
+    """
+    Hash the HTML bodies of a message, ignoring differences in whitespace.
     
-    cursor.execute('''INSERT INTO customers (name, address, phone_number, email_address)
+    Reminders and duplicates of a PO email carry the same bodies under a new
+    message ID, so an equal fingerprint means the content was seen before.
+    Much cheaper than parsing; the bodies may be str or bytes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for html_content in html_parts:
+        if isinstance(html_content, str):
+            html_content = html_content.encode()
+        html_content = _BETWEEN_TAGS.sub(b"><", html_content)
+        digest.update(_WHITESPACE.sub(b" ", html_content).strip())
+        digest.update(b"\0")  # Part separator
+    return digest.hexdigest()
+
+
+# Upsert statements shared by save_to_database and DatabaseWriter
+CUSTOMER_UPSERT = '''INSERT INTO customers (name, address, phone_number, email_address)
                       VALUES (?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET 
-                      address=excluded.address, phone_number=excluded.phone_number, email_address=excluded.email_address''',
-                   (customer["name"], customer["address"], customer["phone_number"], customer["email_address"]))
-    
-    cursor.execute('''INSERT INTO orders (po_number, customer_name, sold_on, must_ship_by, ship_method, delivery_type, payment_method)
+                      address=excluded.address, phone_number=excluded.phone_number, email_address=excluded.email_address'''
+
+ORDER_UPSERT = '''INSERT INTO orders (po_number, customer_name, sold_on, must_ship_by, ship_method, delivery_type, payment_method)
                       VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(po_number) DO UPDATE SET
                       customer_name=excluded.customer_name, sold_on=excluded.sold_on, must_ship_by=excluded.must_ship_by,
-                      ship_method=excluded.ship_method, delivery_type=excluded.delivery_type, payment_method=excluded.payment_method''',
-                   (order["po_number"], order["customer_name"], order["sold_on"], order["must_ship_by"],
-                    order["ship_method"], order["delivery_type"], order["payment_method"]))
-    
-    for product in products:
-        cursor.execute('''INSERT INTO products (item_code, description)
-                          VALUES (?, ?) ON CONFLICT(item_code) DO UPDATE SET description=excluded.description''',
-                       (product["item_code"], product["description"]))
+                      ship_method=excluded.ship_method, delivery_type=excluded.delivery_type, payment_method=excluded.payment_method'''
+
+PRODUCT_UPSERT = '''INSERT INTO products (item_code, description)
+                          VALUES (?, ?) ON CONFLICT(item_code) DO UPDATE SET description=excluded.description'''
+
+ORDER_ITEM_UPSERT = '''INSERT INTO order_items (order_po_number, product_item_code, quantity, price, line_number)
+                          VALUES (?, ?, ?, ?, ?) ON CONFLICT(order_po_number, product_item_code, line_number) DO UPDATE SET
+                          quantity=excluded.quantity, price=excluded.price'''
+
+# A re-sent PO replaces the line items of the earlier version
+ORDER_ITEMS_DELETE = "DELETE FROM order_items WHERE order_po_number = ?"
+
+FINGERPRINT_UPSERT = '''INSERT INTO content_fingerprints (fingerprint, po_number, message_id, ingested_at)
+                      VALUES (?, ?, ?, ?) ON CONFLICT(fingerprint) DO UPDATE SET
+                      po_number=excluded.po_number, message_id=excluded.message_id, ingested_at=excluded.ingested_at'''
+
+PROCESSED_EMAIL_UPSERT = '''INSERT INTO processed_emails (account, message_id, processed_at)
+                      VALUES (?, ?, ?) ON CONFLICT(account, message_id) DO UPDATE SET processed_at=excluded.processed_at'''
+
+WRITE_BATCH_SIZE = 200  # Messages per transaction in DatabaseWriter
+DIMENSION_CACHE_SIZE = 10000  # Customers and products remembered by DatabaseWriter, each
+
+# How lines of one PO that repeat an item code are stored: "sum" adds them up
+# into one line, "separate" keeps a row per line
+REPEATED_ITEMS_MODES = ("sum", "separate")
+REPEATED_ITEMS = "sum"
+
+
+def _customer_row(customer):
+    return (customer["name"], customer["address"], customer["phone_number"], customer["email_address"])
+
+
+def _order_row(order):
+    return (order["po_number"], order["customer_name"], order["sold_on"], order["must_ship_by"],
+            order["ship_method"], order["delivery_type"], order["payment_method"])
+
+
+def _product_row(product):
+    return (product["item_code"], product["description"])
+
+
+def _order_item_row(item):
+    return (item["order_po_number"], item["product_item_code"], item["quantity"], item["price"],
+            item["line_number"])
+
+
+def merge_repeated_items(order_items, repeated_items=REPEATED_ITEMS):
+    """
+    Apply the repeated_items mode to the order items of one PO.
     
+    With "sum", lines repeating an item code are folded into its first line
+    and their quantities added up; the price of the first line is kept.
+    With "separate", the items are returned as they are.
+    """
+    if repeated_items not in REPEATED_ITEMS_MODES:
+        raise ValueError(f"repeated_items must be one of {REPEATED_ITEMS_MODES}, not {repeated_items!r}")
+    if repeated_items == "separate":
+        return order_items
+    merged = {}
     for item in order_items:
-        cursor.execute('''INSERT INTO order_items (order_po_number, product_item_code, quantity, price)
-                          VALUES (?, ?, ?, ?) ON CONFLICT(order_po_number, product_item_code) DO UPDATE SET
-                          quantity=excluded.quantity, price=excluded.price''',
-                       (item["order_po_number"], item["product_item_code"], item["quantity"], item["price"]))
+        first = merged.get(item["product_item_code"])
+        if first is None:
+            merged[item["product_item_code"]] = dict(item, line_number=1)
+        else:
+            first["quantity"] += item["quantity"]
+    return list(merged.values())
+
+
+class DimensionCache:
+    """
+    Bounded LRU map from a customer name or item code to the hash of the row
+    last written for it, so that writing the same row again can be skipped.
+    
+    It only knows the rows written through its own DatabaseWriter, so it
+    assumes nothing else changes them while the writer is open.
+    """
+    
+    def __init__(self, size=DIMENSION_CACHE_SIZE):
+        self.size = size
+        self.hashes = OrderedDict()
+        self.hits = 0
+    
+    def is_current(self, row):
+        """Return True if row (keyed by its first value) was the last one written."""
+        if self.hashes.get(row[0]) != hash(row):
+            return False
+        self.hashes.move_to_end(row[0])
+        self.hits += 1
+        return True
+    
+    def update(self, rows):
+        """Remember rows that have been committed."""
+        for row in rows:
+            self.hashes[row[0]] = hash(row)
+            self.hashes.move_to_end(row[0])
+        while len(self.hashes) > self.size:
+            self.hashes.popitem(last=False)
+
+
+# Function to save data to SQLite
+def save_to_database(customer, order, products, order_items, repeated_items=REPEATED_ITEMS):
+    order_items = merge_repeated_items(order_items, repeated_items)
+    conn = sqlite3.connect("orders.db")
+    cursor = conn.cursor()
+    
+    cursor.execute(CUSTOMER_UPSERT, _customer_row(customer))
+    cursor.execute(ORDER_UPSERT, _order_row(order))
+    cursor.execute(ORDER_ITEMS_DELETE, (order["po_number"],))
+    cursor.executemany(PRODUCT_UPSERT, [_product_row(product) for product in products])
+    cursor.executemany(ORDER_ITEM_UPSERT, [_order_item_row(item) for item in order_items])
     
     conn.commit()
     conn.close()
 
-# Function to export data to Excel
-def export_to_excel():
-    conn = sqlite3.connect("orders.db")
+
+class DatabaseWriter:
+    """
+    Write parsed messages over one long-lived connection.
     
-    customers_df = pd.read_sql_query("SELECT * FROM customers", conn)
-    products_df = pd.read_sql_query("SELECT * FROM products", conn)
-    orders_df = pd.read_sql_query("SELECT * FROM orders", conn)
+    Messages passed to add() are written batch_size at a time, each batch in
+    one transaction with its processed_emails rows (for account, unless
+    add() names another), so an order is never saved without its message
+    being marked; saved counts the messages marked. Messages that can't be
+    written are recorded in failures as (message_id, error) pairs instead
+    of failing the whole batch.
     
-    # Query to get orders count and sum of product quantity for each customer
-    orders_count_df = pd.read_sql_query("""
-        SELECT customer_name, COUNT(*) as orders_count
-        FROM orders
-        GROUP BY customer_name
-    """, conn)
+    claim() and release() track which content (see content_fingerprint) is
+    being ingested; add_duplicate() only marks a repeat processed.
+    Unchanged customers and products are skipped (see DimensionCache), and
+    order items are merged according to repeated_items.
     
-    product_quantity_sum_df = pd.read_sql_query("""
-        SELECT o.customer_name, SUM(oi.quantity) as total_product_quantity
-        FROM orders o
-        JOIN order_items oi ON o.po_number = oi.order_po_number
-        GROUP BY o.customer_name
-    """, conn)
+    Usage:
+        with DatabaseWriter() as writer:
+            writer.add(msg_id, [(customer, order, products, order_items)])
+    """
     
-    # Merge the data with customers DataFrame
-    customers_df = customers_df.merge(orders_count_df, left_on="name", right_on="customer_name", how="left")
-    customers_df = customers_df.merge(product_quantity_sum_df, left_on="name", right_on="customer_name", how="left")
+    thread_safe = False  # See SharedWriter
     
-    # Drop the extra customer_name columns from the merge
-    customers_df = customers_df.drop(columns=["customer_name_x", "customer_name_y"])
+    def __init__(self, db_path="orders.db", batch_size=WRITE_BATCH_SIZE, repeated_items=REPEATED_ITEMS,
+                 cache_size=DIMENSION_CACHE_SIZE, account=""):
+        if repeated_items not in REPEATED_ITEMS_MODES:
+            raise ValueError(f"repeated_items must be one of {REPEATED_ITEMS_MODES}, not {repeated_items!r}")
+        self.batch_size = batch_size
+        self.repeated_items = repeated_items
+        self.account = account
+        self.customer_cache = DimensionCache(cache_size)
+        self.product_cache = DimensionCache(cache_size)
+        self.pending = []
+        self.failures = []
+        self.failures_by_account = {}
+        self.claimed = set()  # Fingerprints added to this writer
+        self.released = set()  # Claimed fingerprints whose message failed
+        self.duplicates = 0
+        self.duplicates_by_account = {}
+        self.saved = 0
+        self.saved_by_account = {}
+        self.conn = sqlite3.connect(db_path, check_same_thread=not self.thread_safe)
+        # WAL keeps readers (the GUI status) unblocked and makes commits cheap
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-16000")  # 16 MB
     
-    with pd.ExcelWriter("exported_data.xlsx") as writer:
-        customers_df.to_excel(writer, sheet_name="Customers", index=False)
-        products_df.to_excel(writer, sheet_name="Products", index=False)
-        orders_df.to_excel(writer, sheet_name="Orders", index=False)
+    def claim(self, fingerprint):
+        """
+        Return True if content with this fingerprint is new and should be
+        parsed, False if it was already ingested or claimed.
+        """
+        if fingerprint in self.claimed:
+            return False
+        self.claimed.add(fingerprint)
+        self.released.discard(fingerprint)
+        row = self.conn.execute(
+            "SELECT 1 FROM content_fingerprints WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        return row is None
     
-    conn.close()
+    def release(self, fingerprint):
+        """
+        Give up the claim of a message that failed, so its content is parsed
+        again when it turns up next. Repeats already queued behind it fail
+        too rather than being marked processed.
+        """
+        self.claimed.discard(fingerprint)
+        self.released.add(fingerprint)
+    
+    def add(self, message_id, records, fingerprint=None, account=None):
+        """Queue the parsed records of one message, writing once a batch is full."""
+        account = self.account if account is None else account
+        self.pending.append((message_id, records, fingerprint, account))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+    
+    def add_duplicate(self, message_id, fingerprint=None, account=None):
+        """Queue a message whose content was already ingested, only to mark it processed."""
+        account = self.account if account is None else account
+        if fingerprint in self.released:
+            self._fail(message_id, account, "the message with the same content failed", "dedup")
+            return
+        self._count_duplicates(account, 1)
+        self.add(message_id, None, fingerprint, account)
+    
+    def failures_for(self, account):
+        """Return the (message_id, error) failures of one account."""
+        return self.failures_by_account.get(account, [])
+    
+    def _fail(self, message_id, account, error, stage="write"):
+        print(f"An error occurred saving message {message_id}: {error}")
+        failure = (message_id, error)
+        self.failures.append(failure)
+        self.failures_by_account.setdefault(account, []).append(failure)
+        metrics.fail(stage)
+    
+    def _count_duplicates(self, account, count):
+        self.duplicates += count
+        self.duplicates_by_account[account] = self.duplicates_by_account.get(account, 0) + count
+    
+    def flush(self):
+        """Write all queued messages in one transaction."""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        with metrics.stage("write"):
+            try:
+                self._write(batch)
+            except sqlite3.Error:
+                # Retry one message per transaction to find the ones that fail
+                for message in batch:
+                    message_id, records, fingerprint, account = message
+                    if records is None and fingerprint in self.released:
+                        self._count_duplicates(account, -1)
+                        self._fail(message_id, account, "the message with the same content failed", "dedup")
+                        continue
+                    try:
+                        self._write([message])
+                    except sqlite3.Error as error:
+                        self._fail(message_id, account, f"{type(error).__name__}: {error}")
+                        if records is not None and fingerprint is not None:
+                            self.release(fingerprint)  # Let a later copy try again
+    
+    def _write(self, batch):
+        # Keyed by name, item code and PO number: the last version wins
+        customers, orders, products, processed, fingerprints = {}, {}, {}, [], []
+        processed_at = datetime.now().isoformat()
+        for message_id, records, fingerprint, account in batch:
+            if records is None:  # A duplicate
+                processed.append((account, message_id, processed_at))
+                continue
+            for customer, order, message_products, message_items in records:
+                customers[customer["name"]] = _customer_row(customer)
+                orders[order["po_number"]] = (_order_row(order), message_items)
+                for product in message_products:
+                    products[product["item_code"]] = _product_row(product)
+            if records:
+                processed.append((account, message_id, processed_at))
+                if fingerprint is not None:
+                    fingerprints.append((fingerprint, records[0][1]["po_number"], message_id, processed_at))
+        
+        customers = [row for row in customers.values() if not self.customer_cache.is_current(row)]
+        products = [row for row in products.values() if not self.product_cache.is_current(row)]
+        order_items = [
+            _order_item_row(item)
+            for _, message_items in orders.values()
+            for item in merge_repeated_items(message_items, self.repeated_items)
+        ]
+        orders = [order_row for order_row, _ in orders.values()]
+        
+        with self.conn:
+            self.conn.executemany(CUSTOMER_UPSERT, customers)
+            self.conn.executemany(ORDER_UPSERT, orders)
+            self.conn.executemany(ORDER_ITEMS_DELETE, [row[:1] for row in orders])
+            self.conn.executemany(PRODUCT_UPSERT, products)
+            self.conn.executemany(ORDER_ITEM_UPSERT, order_items)
+            self.conn.executemany(PROCESSED_EMAIL_UPSERT, processed)
+            self.conn.executemany(FINGERPRINT_UPSERT, fingerprints)
+        self.customer_cache.update(customers)
+        self.product_cache.update(products)
+        self.saved += len(processed)
+        for account, _, _ in processed:
+            self.saved_by_account[account] = self.saved_by_account.get(account, 0) + 1
+    
+    def close(self):
+        """Flush queued messages and close the connection."""
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SharedWriter(DatabaseWriter):
+    """
+    A DatabaseWriter that several ingestion threads, one per account, share.
+    
+    Every call holds one lock, so the writes to orders.db stay serialized
+    over a single connection, and messages of all the accounts are batched
+    together. Each thread writes through its own for_account() view.
+    """
+    
+    thread_safe = True
+    
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.RLock()  # add() may flush while holding it
+        super().__init__(*args, **kwargs)
+    
+    def claim(self, fingerprint):
+        with self.lock:
+            return super().claim(fingerprint)
+    
+    def add(self, message_id, records, fingerprint=None, account=None):
+        with self.lock:
+            super().add(message_id, records, fingerprint, account)
+    
+    def release(self, fingerprint):
+        with self.lock:
+            super().release(fingerprint)
+    
+    def add_duplicate(self, message_id, fingerprint=None, account=None):
+        with self.lock:
+            super().add_duplicate(message_id, fingerprint, account)
+    
+    def flush(self):
+        with self.lock:
+            super().flush()
+    
+    def close(self):
+        with self.lock:
+            super().close()
+    
+    def for_account(self, account):
+        return AccountWriter(self, account)
 
+
+class AccountWriter:
+    """
+    The part of a SharedWriter one account writes through, with the same
+    methods as a DatabaseWriter. Messages are marked processed for account,
+    and failures and duplicates only count the account's own messages.
+    """
+    
+    def __init__(self, shared, account):
+        self.shared = shared
+        self.account = account
+    
+    @property
+    def failures(self):
+        return self.shared.failures_for(self.account)
+    
+    @property
+    def duplicates(self):
+        return self.shared.duplicates_by_account.get(self.account, 0)
+    
+    @property
+    def saved(self):
+        return self.shared.saved_by_account.get(self.account, 0)
+    
+    def claim(self, fingerprint):
+        return self.shared.claim(fingerprint)
+    
+    def release(self, fingerprint):
+        self.shared.release(fingerprint)
+    
+    def add(self, message_id, records, fingerprint=None):
+        self.shared.add(message_id, records, fingerprint, self.account)
+    
+    def add_duplicate(self, message_id, fingerprint=None):
+        self.shared.add_duplicate(message_id, fingerprint, self.account)
+    
+    def flush(self):
+        self.shared.flush()
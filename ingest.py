@@ -0,0 +1,717 @@
+import base64
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from extract import (
+    REPEATED_ITEMS,
+    DatabaseWriter,
+    SharedWriter,
+    content_fingerprint,
+    extract_data_from_html,
+    setup_database,
+)
+from pipeline import PARSE_WORKERS, SharedPool, run_pipeline
+from archive import EmailArchive, archive_path
+from auth import CredentialManager, SessionPool
+import metrics
+from scheduler import MAX_RETRIES, backoff_delay, scheduler_for
+import sqlite3
+from datetime import datetime
+
+WAYFAIR_TITLE = "Action Required: PO"
+PIPELINE_THRESHOLD = 200  # Parse in a process pool from this many messages on
+EARLY_STOP_PAGES = 2  # Stop listing after this many fully processed pages in a row
+MESSAGE_ATTEMPTS = 3  # Runs a failed Gmail message is fetched in before it is given up
+LOOKUP_CHUNK_SIZE = 500  # IDs per processed_emails lookup query
+MIME_DEPTH = 5  # Levels of nested multipart parts requested by the field mask
+
+
+def _parts_mask(depth):
+    """Field mask for a MIME part and its children, depth levels deep."""
+    fields = "partId,mimeType,filename,body(attachmentId,data)"
+    if depth > 1:
+        fields += f",parts({_parts_mask(depth - 1)})"
+    return fields
+
+
+# Only the MIME structure and bodies; headers and metadata are left out
+MESSAGE_FIELDS = f"id,payload({_parts_mask(MIME_DEPTH)})"
+
+
+# The services built by get_gmail_service, by account, reused for the rest of the process
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_gmail_service(account="", max_batch_size=None):
+    """Gets authenticated Gmail API service of an account ("" is the default one).
+
+    The service is built once per account and process, and its scheduler
+    (see scheduler_for) caps batch requests at max_batch_size messages.
+    """
+    with _services_lock:  # At most one consent flow at a time
+        if account in _services:
+            scheduler_for(_services[account], max_batch_size=max_batch_size)
+            return _services[account]
+
+        from googleapiclient.discovery import build
+
+        creds = CredentialManager.for_account(account).get_credentials()
+        service = build(
+            "gmail", "v1", credentials=creds, static_discovery=True, cache_discovery=False
+        )
+        scheduler_for(service, sessions=SessionPool(creds), max_batch_size=max_batch_size)
+        _services[account] = service
+        return service
+
+
+def filter_unprocessed(msg_ids, conn=None, account=""):
+    """Return the IDs in msg_ids that account has not processed yet, in order.
+
+    Looks the IDs up through the processed_emails primary key, a chunk at a
+    time, instead of loading every processed ID into memory.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect("orders.db")
+    processed_ids = set()
+    for start in range(0, len(msg_ids), LOOKUP_CHUNK_SIZE):
+        chunk = msg_ids[start : start + LOOKUP_CHUNK_SIZE]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor = conn.execute(
+            f"""SELECT message_id FROM processed_emails
+                WHERE account = ? AND message_id IN ({placeholders})""",
+            [account, *chunk],
+        )
+        processed_ids.update(row[0] for row in cursor)
+    if own_conn:
+        conn.close()
+    return [msg_id for msg_id in msg_ids if msg_id not in processed_ids]
+
+
+def get_history_watermark(account=""):
+    """Return the historyId recorded by the last complete extraction of account, if any."""
+    conn = sqlite3.connect("orders.db")
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT history_id FROM extraction_logs
+           WHERE history_id IS NOT NULL AND account = ? ORDER BY id DESC LIMIT 1""",
+        (account,),
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def list_msg_with_title(
+    service,
+    user_id="me",
+    title="Action Required: PO",
+    limit=None,
+    stop_after_processed_pages=EARLY_STOP_PAGES,
+    account="",
+):
+    """List messages with the specified title, excluding already processed ones.
+
+    Gmail lists messages newest first, so paging stops once
+    stop_after_processed_pages pages in a row held only processed messages
+    (0 or None pages through everything). A failed list call raises, so
+    that a partial listing isn't taken for a complete one.
+    """
+    scheduler = scheduler_for(service)
+    conn = sqlite3.connect("orders.db")
+    try:
+        new_messages = []
+        page_token = None
+        processed_pages = 0
+
+        while True:
+            response = scheduler.execute(
+                service.users()
+                .messages()
+                .list(
+                    userId=user_id,
+                    maxResults=500,  # API hard limit
+                    q=f'subject:"{title}"',
+                    pageToken=page_token,
+                ),
+                "messages.list",
+            )
+
+            messages = response.get("messages", [])
+            if not messages:
+                break
+
+            # Filter out already processed messages
+            unprocessed_ids = set(
+                filter_unprocessed([msg["id"] for msg in messages], conn, account)
+            )
+            new_messages.extend(msg for msg in messages if msg["id"] in unprocessed_ids)
+
+            # Stop once the older pages can only hold processed messages
+            processed_pages = 0 if unprocessed_ids else processed_pages + 1
+            if stop_after_processed_pages and processed_pages >= stop_after_processed_pages:
+                break
+
+            # Stop if we hit the requested limit
+            if limit and len(new_messages) >= limit:
+                new_messages = new_messages[:limit]
+                break
+
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+
+        print(f"Found {len(new_messages)} new messages.")
+        return new_messages
+
+    finally:
+        conn.close()
+
+
+def list_msg_since_history(
+    service, start_history_id, user_id="me", title=WAYFAIR_TITLE, account=""
+):
+    """List messages with the specified title added since start_history_id.
+
+    Only the changes recorded by the history endpoint are read, so the cost
+    depends on the new mail rather than the mailbox size. Raises HttpError
+    (404) when start_history_id is too old to be served, and RuntimeError
+    when the subject of an added message can't be read.
+    """
+    scheduler = scheduler_for(service)
+    added_ids = {}  # Used as an ordered set
+    page_token = None
+
+    while True:
+        response = scheduler.execute(
+            service.users()
+            .history()
+            .list(
+                userId=user_id,
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                pageToken=page_token,
+            ),
+            "history.list",
+        )
+
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                added_ids[added["message"]["id"]] = None
+
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+    # The history endpoint can't search, so check the subject ourselves
+    new_messages = []
+    unreadable = 0
+    for msg_id, message in fetch_messages(
+        service,
+        filter_unprocessed(list(added_ids), account=account),
+        user_id,
+        format="metadata",
+        metadataHeaders=["Subject"],
+    ):
+        if message is None:
+            unreadable += 1
+            continue
+        headers = message["payload"].get("headers", [])
+        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
+        if title.lower() in subject.lower():
+            new_messages.append({"id": msg_id, "threadId": message.get("threadId")})
+    if unreadable:
+        raise RuntimeError(f"{unreadable} added messages could not be read")
+
+    print(f"Found {len(new_messages)} new messages since history {start_history_id}.")
+    return new_messages
+
+
+def list_new_messages(
+    service,
+    user_id="me",
+    title=WAYFAIR_TITLE,
+    account="",
+    stop_after_processed_pages=EARLY_STOP_PAGES,
+):
+    """List unprocessed messages, incrementally when a watermark is stored.
+
+    Processed messages, the watermark and failed messages are looked up for
+    account, the one the service belongs to. The messages that failed in
+    fewer than MESSAGE_ATTEMPTS earlier runs are listed again.
+    stop_after_processed_pages is passed on to a full scan (see
+    list_msg_with_title).
+
+    Returns (messages, history_id) where history_id is the mailbox watermark
+    to record once these messages have been processed, or None if the
+    listing failed.
+    """
+    try:
+        profile = scheduler_for(service).execute(
+            service.users().getProfile(userId=user_id), "getProfile"
+        )
+        history_id = profile["historyId"]
+    except Exception as error:
+        print(f"An error occurred reading the mailbox profile: {error}")
+        metrics.fail("list")
+        history_id = None
+
+    watermark = get_history_watermark(account)
+    messages = None
+    if watermark and history_id:
+        from googleapiclient.errors import HttpError  # Loaded with the service
+
+        try:
+            messages = list_msg_since_history(service, watermark, user_id, title, account)
+        except Exception as error:
+            if isinstance(error, HttpError) and error.resp.status == 404:
+                print("History watermark expired, falling back to a full scan.")
+            else:
+                print(f"An error occurred in history sync, falling back to a full scan: {error}")
+                metrics.fail("list")
+
+    if messages is None:
+        try:
+            messages = list_msg_with_title(
+                service,
+                user_id,
+                title,
+                stop_after_processed_pages=stop_after_processed_pages,
+                account=account,
+            )
+        except Exception as error:
+            # Nothing is known about the new mail, so the watermark must stay
+            print(f"An error occurred listing messages: {error}")
+            metrics.fail("list")
+            return [], None
+
+    listed = {message["id"] for message in messages}
+    retries = [msg_id for msg_id in retry_candidates(account) if msg_id not in listed]
+    if retries:
+        print(f"Retrying {len(retries)} messages that failed before.")
+    return messages + [{"id": msg_id} for msg_id in retries], history_id
+
+
+def retry_candidates(account=""):
+    """Return the IDs of account's failed messages that are still retried."""
+    conn = sqlite3.connect("orders.db")
+    cursor = conn.execute(
+        """SELECT message_id FROM failed_emails
+           WHERE account = ? AND attempts < ? ORDER BY failed_at""",
+        (account, MESSAGE_ATTEMPTS),
+    )
+    msg_ids = [row[0] for row in cursor]
+    conn.close()
+    return msg_ids
+
+
+def record_failures(failures, account=""):
+    """Count a failed run for each (msg_id, error) pair in failures.
+
+    Messages that are processed later are cleared by a trigger on
+    processed_emails.
+    """
+    if not failures:
+        return
+    failed_at = datetime.now().isoformat()
+    conn = sqlite3.connect("orders.db")
+    with conn:
+        conn.executemany(
+            """INSERT INTO failed_emails (account, message_id, error, failed_at)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(account, message_id) DO UPDATE SET
+                   attempts = attempts + 1, error = excluded.error, failed_at = excluded.failed_at""",
+            [(account, msg_id, str(error), failed_at) for msg_id, error in failures],
+        )
+        given_up = conn.execute(
+            """SELECT message_id FROM failed_emails
+               WHERE account = ? AND failed_at = ? AND attempts = ?""",
+            (account, failed_at, MESSAGE_ATTEMPTS),
+        ).fetchall()
+    conn.close()
+    for (msg_id,) in given_up:
+        print(f"Message {msg_id} failed in {MESSAGE_ATTEMPTS} runs, it won't be fetched again.")
+
+
+def fetch_messages(service, msg_ids, user_id="me", **get_kwargs):
+    """Fetch messages through Gmail batch requests.
+
+    Yields (msg_id, message) pairs in the same order as msg_ids. A message
+    that failed to download is yielded as None. Batches are sized and paced
+    by the service's RequestScheduler, and messages that hit a rate limit or
+    a server error are retried with backoff. Extra keyword arguments (e.g.
+    format) are passed on to messages().get().
+    """
+    scheduler = scheduler_for(service)
+    waiting = deque(msg_ids)
+    attempts = {}
+    results = {}
+    next_index = 0
+
+    while waiting:
+        chunk = [waiting.popleft() for _ in range(min(scheduler.batch_size, len(waiting)))]
+        requests = [
+            (msg_id, service.users().messages().get(userId=user_id, id=msg_id, **get_kwargs))
+            for msg_id in chunk
+        ]
+        try:
+            with metrics.stage("fetch"):
+                responses, retry, errors = scheduler.execute_batch(
+                    service, requests, "messages.get"
+                )
+        except Exception as error:
+            print(f"An error occurred in batch fetch: {error}")
+            responses, retry, errors = {}, [], dict.fromkeys(chunk, error)
+
+        results.update(responses)
+        for msg_id, error in errors.items():
+            print(f"An error occurred fetching message {msg_id}: {error}")
+            metrics.fail("fetch")
+            results[msg_id] = None
+
+        retry_now = []
+        for msg_id in retry:
+            attempts[msg_id] = attempts.get(msg_id, 0) + 1
+            if attempts[msg_id] > MAX_RETRIES:
+                print(f"Giving up on message {msg_id} after {MAX_RETRIES} retries.")
+                metrics.fail("fetch")
+                results[msg_id] = None
+            else:
+                retry_now.append(msg_id)
+        if retry_now:
+            delay = backoff_delay(max(attempts[msg_id] for msg_id in retry_now) - 1)
+            metrics.record("throttle", delay)
+            time.sleep(delay)
+            waiting.extendleft(reversed(retry_now))
+
+        # Hand out everything that is ready, keeping the original order
+        while next_index < len(msg_ids) and msg_ids[next_index] in results:
+            msg_id = msg_ids[next_index]
+            yield msg_id, results.pop(msg_id)
+            next_index += 1
+
+
+def is_html_part(part):
+    """Return True for a text/html body, inline or attached."""
+    return part.get("mimeType") == "text/html" or (
+        part.get("filename", "").lower().endswith((".htm", ".html"))
+    )
+
+
+def get_html_parts(service, message, user_id="me"):
+    """Return the HTML bodies of a Gmail message, as bytes.
+
+    Walks the whole MIME tree, so HTML nested in multipart/alternative
+    inside multipart/mixed is found too. Bodies stored as attachments are
+    downloaded on demand.
+    """
+    html_parts = []
+    stack = [message["payload"]]
+    while stack:
+        part = stack.pop()
+        children = part.get("parts")
+        if children:
+            stack.extend(reversed(children))  # Keep document order
+            continue
+        if not is_html_part(part):
+            continue
+        body = part.get("body", {})
+        data = body.get("data")
+        if data is None and body.get("attachmentId"):
+            attachment = scheduler_for(service).execute(
+                service.users()
+                .messages()
+                .attachments()
+                .get(userId=user_id, messageId=message["id"], id=body["attachmentId"]),
+                "messages.attachments.get",
+            )
+            data = attachment["data"]
+        if data:
+            html_parts.append(base64.urlsafe_b64decode(data))
+    return html_parts
+
+
+def fetch_html(service, msg_ids, user_id="me", archive=None):
+    """Fetch messages and yield (msg_id, html_parts) in the order of msg_ids.
+
+    html_parts is None for a message that could not be downloaded. Only the
+    fields in MESSAGE_FIELDS are downloaded. The HTML bodies are also stored
+    in archive, if given.
+    """
+    for msg_id, message in fetch_messages(
+        service, msg_ids, user_id, fields=MESSAGE_FIELDS
+    ):
+        if message is None:
+            yield msg_id, None
+            continue
+        try:
+            with metrics.stage("decode"):
+                html_parts = get_html_parts(service, message, user_id)
+        except Exception as error:
+            print(f"An error occurred decoding message {msg_id}: {error}")
+            yield msg_id, None
+            continue
+        if archive is not None:
+            archive.store(msg_id, html_parts)
+        yield msg_id, html_parts
+
+
+def process_html_parts(msg_id, html_parts, writer):
+    """Extract the data of one message's HTML bodies and queue it in writer.
+
+    Content that was already ingested, e.g. a reminder for the same PO, isn't
+    parsed again; the message is only marked processed. A message without
+    HTML bodies has no content to compare. Returns False if parsing failed.
+    """
+    fingerprint = None
+    if html_parts:
+        with metrics.stage("dedup"):
+            fingerprint = content_fingerprint(html_parts)
+            is_new = writer.claim(fingerprint)
+        if not is_new:
+            writer.add_duplicate(msg_id, fingerprint)
+            return True
+    try:
+        with metrics.stage("parse"):
+            records = [
+                extract_data_from_html(html_content) for html_content in html_parts
+            ]
+    except Exception as error:
+        print(f"An error occurred in processing message data: {error}")
+        if fingerprint is not None:
+            writer.release(fingerprint)
+        return False
+    writer.add(msg_id, records, fingerprint)
+    return True
+
+
+def process_message_data(service, msg_id, user_id="me", message=None, writer=None):
+    """Process the content of a Gmail message.
+
+    If the message was already downloaded (see fetch_messages) it is used
+    directly, otherwise it is fetched on its own. The extracted data goes to
+    writer, or is saved right away when no writer is given. Returns False if
+    the message could not be fetched or parsed.
+    """
+    try:
+        if message is None:
+            message = scheduler_for(service).execute(
+                service.users()
+                .messages()
+                .get(userId=user_id, id=msg_id, fields=MESSAGE_FIELDS),
+                "messages.get",
+            )
+        html_parts = get_html_parts(service, message, user_id)
+    except Exception as error:
+        print(f"An error occurred in processing message data: {error}")
+        return False
+
+    # Save the data together with the processed email record
+    if writer is None:
+        with DatabaseWriter(batch_size=1) as single_writer:
+            processed = process_html_parts(msg_id, html_parts, single_writer)
+        return processed and not single_writer.failures
+    return process_html_parts(msg_id, html_parts, writer)
+
+
+def log_extraction(history_id=None, account="", messages=None, processed=None, seconds=None):
+    """Log an extraction call of an account, with the mailbox watermark it reached.
+
+    messages is the number of new messages listed and processed the number
+    saved, in seconds. Returns the id of the new extraction_logs row.
+    """
+    conn = sqlite3.connect("orders.db")
+    cursor = conn.cursor()
+    cursor.execute(
+        """INSERT INTO extraction_logs (timestamp, history_id, account, messages, processed, seconds)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        (datetime.now().isoformat(), history_id, account, messages, processed, seconds),
+    )
+    log_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return log_id
+
+
+def run_ingestion(
+    source,
+    archive=True,
+    workers=None,
+    on_progress=None,
+    cancel=None,
+    profile=True,
+    repeated_items=REPEATED_ITEMS,
+):
+    """Run the extraction pipeline over the new messages of a source.
+
+    source is one of the classes in sources.py, on_progress(done, total) is
+    called after each message and setting cancel (a threading.Event) stops
+    the run once the messages in flight are committed. profile stores stage
+    timings (see metrics.py). Returns a dict of run statistics, where
+    processed counts the messages saved, as extraction_logs does.
+    """
+    setup_database()  # Ensure the database is set up
+    if profile:
+        metrics.start_run()
+    try:
+        stats, log_id = _run_ingestion(
+            source, archive, workers, on_progress, cancel, repeated_items
+        )
+    finally:
+        profiler = metrics.stop_run()
+    if profiler is not None:
+        metrics.save_metrics(log_id, profiler)
+    return stats
+
+
+def _run_ingestion(
+    source, archive, workers, on_progress, cancel, repeated_items, writer=None, executor=None
+):
+    started = time.perf_counter()
+    with metrics.stage("list"):
+        msg_ids = source.list_new()
+    total = len(msg_ids)
+    failed = []
+    duplicates = 0
+    processed = 0
+    done = 0
+
+    if msg_ids:
+
+        def report_progress(msg_id):
+            nonlocal done
+            done += 1
+            if on_progress:
+                on_progress(done, total)
+
+        with (
+            nullcontext(writer) if writer is not None
+            else DatabaseWriter(repeated_items=repeated_items, account=source.account)
+        ) as writer, (
+            EmailArchive(archive_path(source.account)) if archive else nullcontext()
+        ) as email_archive:
+            fetched = source.fetch(msg_ids, archive=email_archive)
+            if workers or total >= PIPELINE_THRESHOLD:
+                # Bulk run: parse in a process pool while this thread fetches and writes
+                pipeline_options = {"workers": workers} if workers else {}
+                failed = run_pipeline(
+                    fetched,
+                    writer,
+                    on_progress=report_progress,
+                    cancel=cancel,
+                    executor=executor,
+                    **pipeline_options,
+                )
+            else:
+                for msg_id, html_parts in fetched:
+                    if cancel is not None and cancel.is_set():
+                        break
+                    if html_parts is None:
+                        failed.append((msg_id, "message could not be fetched"))
+                    elif not process_html_parts(msg_id, html_parts, writer):
+                        failed.append((msg_id, "message could not be parsed"))
+                    report_progress(msg_id)
+                writer.flush()
+                failed += writer.failures
+            duplicates = writer.duplicates
+            processed = writer.saved
+
+    # Log the extraction call. Failed messages don't hold the watermark
+    # back, they are fetched again from failed_emails; a cancelled run keeps
+    # the previous one so the next run lists the rest again, as does a run
+    # whose listing failed (history_id is None then).
+    record_failures(failed, source.account)
+    cancelled = done < total
+    seconds = time.perf_counter() - started
+    log_id = log_extraction(
+        None if cancelled else source.history_id,
+        source.account,
+        total,
+        processed,
+        seconds,
+    )
+
+    metrics.record("run", seconds)
+    return {
+        "messages": total,
+        "handled": done,
+        "processed": processed,
+        "failures": len(failed),
+        "duplicates": duplicates,
+        "cancelled": cancelled,
+        "seconds": seconds,
+        "messages_per_second": processed / seconds if seconds else 0.0,
+    }, log_id
+
+
+def run_accounts(
+    sources,
+    archive=True,
+    workers=None,
+    on_progress=None,
+    cancel=None,
+    profile=True,
+    repeated_items=REPEATED_ITEMS,
+):
+    """Run the extraction over several mailboxes at once, one thread per source.
+
+    Each source has its own account (see GmailSource). Sources are connected
+    one after the other first, so at most one browser consent flow opens,
+    then their mailboxes are listed and fetched concurrently. Accounts with
+    PIPELINE_THRESHOLD new messages or more parse them in one shared process
+    pool, started when first needed, and all write to orders.db through one
+    SharedWriter. on_progress(account, done, total) is called after each
+    message; the other arguments are as for run_ingestion. Each account's
+    stage timings are saved with its own extraction_logs row; a batch write
+    counts towards the account whose message filled it. Returns a dict of
+    run statistics per account, or {"error": message} for an account that
+    failed.
+    """
+    setup_database()  # Ensure the database is set up
+    results = {}
+
+    def ingest(source, writer, executor):
+        report_progress = None
+        if on_progress:
+            def report_progress(done, total):
+                on_progress(source.account, done, total)
+        if profile:
+            metrics.start_run()  # Profiles are per thread, so per account
+        try:
+            stats, log_id = _run_ingestion(
+                source, archive, workers, report_progress, cancel, repeated_items,
+                writer.for_account(source.account), executor,
+            )
+        except Exception as error:
+            print(f"An error occurred ingesting account {source.account!r}: {error}")
+            results[source.account] = {"error": f"{type(error).__name__}: {error}"}
+            return
+        finally:
+            profiler = metrics.stop_run()
+        results[source.account] = stats
+        if profiler is not None:
+            metrics.save_metrics(log_id, profiler)
+
+    connected = []
+    for source in sources:
+        try:
+            source.connect()
+        except Exception as error:
+            print(f"An error occurred connecting account {source.account!r}: {error}")
+            results[source.account] = {"error": f"{type(error).__name__}: {error}"}
+        else:
+            connected.append(source)
+    with SharedWriter(repeated_items=repeated_items) as writer, SharedPool(
+        workers or PARSE_WORKERS
+    ) as executor:
+        threads = [
+            threading.Thread(target=ingest, args=(source, writer, executor))
+            for source in connected
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results
@@ -1,192 +1,233 @@
-import os
-import pickle
-import base64
+import queue
+import threading
+import time
 import tkinter as tk
 from tkinter import messagebox
 from tkinter import ttk  # Import ttk for the progress bar
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from extract import (
-    setup_database,
-    extract_data_from_html,
-    save_to_database,
-    export_to_excel,
-)
+from extract import read_account_status, read_status, setup_database
+from export import export_to_excel
+from archive import EmailArchive, archive_path, archived_accounts, replay_archive
+from auth import all_accounts
+from sources import GmailSource
+from ingest import run_accounts, run_ingestion
 import sqlite3
-import pandas as pd
-
-WAYFAIR_TITLE = "Action Required: PO"
-SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
-
-
-def get_gmail_service():
-    """Gets authenticated Gmail API service."""
-    creds = None
-    if os.path.exists("token.pickle"):
-        with open("token.pickle", "rb") as token:
-            creds = pickle.load(token)
-    if not creds or not creds.valid:
-        flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-        creds = flow.run_local_server(port=0)
-    with open("token.pickle", "wb") as token:
-        pickle.dump(creds, token)
-    return build("gmail", "v1", credentials=creds)
-
-
-def list_msg_with_title(service, user_id="me", title="Action Required: PO", limit=None):
-    """List messages with the specified title, excluding already processed ones."""
-    try:
-        # Fetch already processed email IDs from the database
-        conn = sqlite3.connect("orders.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT message_id FROM processed_emails")
-        processed_ids = {row[0] for row in cursor.fetchall()}
-        conn.close()
-
-        new_messages = []
-        page_token = None
-
-        while True:
-            response = (
-                service.users()
-                .messages()
-                .list(
-                    userId=user_id,
-                    maxResults=500,  # API hard limit
-                    q=f'subject:"{title}"',
-                    pageToken=page_token,
-                )
-                .execute()
-            )
 
-            messages = response.get("messages", [])
-            if not messages:
-                break
-
-            # Filter out already processed messages
-            for msg in messages:
-                if msg["id"] not in processed_ids:
-                    new_messages.append(msg)
-
-            # Stop if we hit the requested limit
-            if limit and len(new_messages) >= limit:
-                new_messages = new_messages[:limit]
-                break
-
-            page_token = response.get("nextPageToken")
-            if not page_token:
-                break
-
-        print(f"Found {len(new_messages)} new messages.")
-        return new_messages
-
-    except Exception as error:
-        print(f"An error occurred: {error}")
-        return []
-
-
-def process_message_data(service, msg_id, user_id="me"):
-    """Process the content of a Gmail message."""
-    try:
-        message = service.users().messages().get(userId=user_id, id=msg_id).execute()
-        headers = message["payload"]["headers"]
-        parts = message["payload"].get("parts")
-        if parts:
-            for part in parts:
-                if part["mimeType"] == "text/html":
-                    data = part["body"]["data"]
-                    html_content = base64.urlsafe_b64decode(data).decode()
-
-                    # Extract and save data to the database
-                    customer, order, products, order_items = extract_data_from_html(
-                        html_content
-                    )
-                    save_to_database(customer, order, products, order_items)
-
-                    # Save the processed email record
-                    conn = sqlite3.connect("orders.db")
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        """INSERT INTO processed_emails (message_id, processed_at)
-                           VALUES (?, ?)""",
-                        (msg_id, pd.Timestamp.now().isoformat()),
+POLL_INTERVAL_MS = 100  # How often the GUI checks on a background run
+
+
+def format_eta(seconds):
+    """Format a number of seconds as minutes and seconds."""
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m {seconds:02d}s"
+
+
+def set_running(running):
+    """Switch the buttons between the idle and the running state."""
+    for button in action_buttons:
+        button.config(state="disabled" if running else "normal")
+    cancel_button.config(state="normal" if running else "disabled")
+
+
+def account_label(account):
+    return account or "default"
+
+
+def run_in_background(task, action, on_done):
+    """Run task(on_progress, cancel) on a worker thread.
+
+    on_progress(done, total, detail="") may add detail lines to the status.
+    The worker reports through a thread-safe queue which the Tk loop polls
+    with root.after, so the window stays responsive. on_done(result) runs
+    on the Tk thread when the task finishes.
+    """
+    global cancel_event
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    started = time.perf_counter()
+
+    def work():
+        try:
+            result = task(
+                lambda done, total, detail="": events.put(("progress", done, total, detail)),
+                cancel_event,
+            )
+            events.put(("done", result))
+        except Exception as error:
+            events.put(("error", error))
+
+    def poll():
+        try:
+            while True:
+                event = events.get_nowait()
+                if event[0] == "progress":
+                    _, done, total, detail = event
+                    rate = done / (time.perf_counter() - started)
+                    eta = (total - done) / rate if rate else 0
+                    progress_bar["maximum"] = total
+                    progress_bar["value"] = done  # Update progress bar
+                    status_label.config(
+                        text=f"{action}: {done}/{total} messages\n"
+                        f"{rate:.1f} messages/sec, ETA {format_eta(eta)}"
+                        + (f"\n{detail}" if detail else "")
                     )
-                    conn.commit()
-                    conn.close()
-    except Exception as error:
-        print(f"An error occurred in processing message data: {error}")
+                else:
+                    set_running(False)
+                    if event[0] == "error":
+                        messagebox.showerror("Error", f"An error occurred: {event[1]}")
+                    else:
+                        on_done(event[1])
+                    update_status()
+                    return
+        except queue.Empty:
+            pass
+        root.after(POLL_INTERVAL_MS, poll)
+
+    set_running(True)
+    threading.Thread(target=work, daemon=True).start()
+    root.after(POLL_INTERVAL_MS, poll)
+
+
+def cancel_run():
+    """Ask the running extraction to stop after the messages in flight."""
+    cancel_event.set()
+    cancel_button.config(state="disabled")
+    status_label.config(text="Cancelling, saving the current batch...")
 
 
 def extract_emails():
     """Extract emails from Gmail and save data to the database."""
-    setup_database()  # Ensure the database is set up
-    service = get_gmail_service()
-    messages = list_msg_with_title(service, title=WAYFAIR_TITLE)
-
-    if not messages:
-        messagebox.showinfo("Info", "No new emails to process.")
+    status_label.config(text="Listing new messages...")
+    accounts = all_accounts() or [""]
+    if len(accounts) > 1:
+        extract_accounts(accounts)
         return
 
-    # Configure the progress bar
-    progress_bar["maximum"] = len(messages)
-    progress_bar["value"] = 0
+    def task(on_progress, cancel):
+        return run_ingestion(
+            GmailSource(account=accounts[0]), on_progress=on_progress, cancel=cancel
+        )
 
-    # Display the total number of new messages
-    total_new_messages = len(messages)
-    status_label.config(text=f"Processing: 0/{total_new_messages} new messages")
-    root.update_idletasks()
+    def on_done(stats):
+        if stats["cancelled"]:
+            messagebox.showinfo(
+                "Cancelled",
+                f"Stopped after {stats['handled']} of {stats['messages']} new emails.",
+            )
+        elif not stats["messages"]:
+            messagebox.showinfo("Info", "No new emails to process.")
+        else:
+            message = "Emails processed and data saved to the database!"
+            if stats["duplicates"]:
+                message += f"\n{stats['duplicates']} repeated emails were skipped."
+            messagebox.showinfo("Success", message)
+
+    run_in_background(task, "Processing", on_done)
+
+
+def extract_accounts(accounts):
+    """Extract the emails of several Gmail accounts at once."""
+
+    def task(on_progress, cancel):
+        progress = dict.fromkeys(accounts, (0, 0))
+        started = time.perf_counter()
+
+        def report_progress(account, done, total):
+            progress[account] = (done, total)
+            elapsed = time.perf_counter() - started
+            detail = "\n".join(
+                f"{account_label(name)}: {done}/{total}, "
+                f"{done / elapsed:.1f}/sec, backlog {total - done}"
+                for name, (done, total) in progress.items()
+            )
+            on_progress(
+                sum(done for done, _ in progress.values()),
+                sum(total for _, total in progress.values()),
+                detail,
+            )
 
-    for i, message in enumerate(messages):
-        process_message_data(service, message["id"])
-        progress_bar["value"] = i + 1  # Update progress bar
-        status_label.config(
-            text=f"Processing: {i + 1}/{total_new_messages} new messages"
+        return run_accounts(
+            [GmailSource(account=account) for account in accounts],
+            on_progress=report_progress,
+            cancel=cancel,
         )
-        root.update_idletasks()  # Refresh the GUI
 
-    # Log the extraction call
-    conn = sqlite3.connect("orders.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO extraction_logs (timestamp) VALUES (?)""",
-        (pd.Timestamp.now().isoformat(),),
-    )
-    conn.commit()
-    conn.close()
+    def on_done(results):
+        lines = []
+        for account, stats in results.items():
+            if "error" in stats:
+                lines.append(f"{account_label(account)}: failed, {stats['error']}")
+            else:
+                lines.append(
+                    f"{account_label(account)}: {stats['processed']} of "
+                    f"{stats['messages']} new emails saved, {stats['failures']} failed, "
+                    f"{stats['duplicates']} repeated"
+                )
+        messagebox.showinfo("Done", "\n".join(lines))
 
-    messagebox.showinfo("Success", "Emails processed and data saved to the database!")
-    update_status()
+    run_in_background(task, "Processing", on_done)
 
 
 def update_status():
     """Update the status in the GUI."""
     setup_database()  # Ensure the database is set up
     conn = sqlite3.connect("orders.db")
-    cursor = conn.cursor()
-
-    # Get counts
-    cursor.execute("SELECT COUNT(*) FROM processed_emails")
-    processed_emails_count = cursor.fetchone()[0]
 
-    cursor.execute("SELECT COUNT(*) FROM customers")
-    customers_count = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM orders")
-    orders_count = cursor.fetchone()[0]
-
-    # Get the last extraction timestamp
-    cursor.execute("SELECT MAX(timestamp) FROM extraction_logs")
-    last_updated = cursor.fetchone()[0]
+    # Counters kept current by triggers, so this doesn't scan any table
+    processed_emails_count, customers_count, orders_count, last_updated = read_status(conn)
+    accounts = read_account_status(conn)
 
     conn.close()
 
     # Update the status label
-    status_label.config(
-        text=f"Processed Emails: {processed_emails_count}\n"
+    text = (
+        f"Processed Emails: {processed_emails_count}\n"
         f"Customers: {customers_count}\n"
         f"Orders: {orders_count}\n"
         f"Last Updated: {last_updated}"
     )
+    if any(account for account, *_ in accounts):
+        # Last run of each mailbox; the backlog is what it didn't get through
+        for account, processed, rate, backlog, _ in accounts:
+            text += f"\n{account_label(account)}: {processed} emails"
+            if rate is not None:
+                text += f", {rate:.1f}/sec, backlog {backlog}"
+    status_label.config(text=text)
+
+
+def reextract_archive():
+    """Re-run the extraction over the locally archived emails."""
+    setup_database()  # Ensure the database is set up
+    accounts = archived_accounts()
+    total_archived = 0
+    for account in accounts:
+        with EmailArchive(archive_path(account)) as archive:
+            total_archived += archive.count()
+    if not total_archived:
+        messagebox.showinfo("Info", "The email archive is empty.")
+        return
+
+    def task(on_progress, cancel):
+        done = 0
+
+        def report_progress(msg_id):
+            nonlocal done
+            done += 1
+            on_progress(done, total_archived)
+
+        failures = 0
+        for account in accounts:
+            failures += len(
+                replay_archive(on_progress=report_progress, cancel=cancel, account=account)
+            )
+        return done - failures
+
+    def on_done(extracted):
+        messagebox.showinfo(
+            "Success",
+            f"Re-extracted {extracted} of {total_archived} archived emails.",
+        )
+
+    run_in_background(task, "Re-extracting", on_done)
 
 
 def create_excel_file():
@@ -196,11 +237,12 @@ def create_excel_file():
 
 
 def main():
-    global status_label, progress_bar, root  # Make widgets accessible globally
+    # Make widgets accessible globally
+    global status_label, progress_bar, root, action_buttons, cancel_button
 
     root = tk.Tk()
     root.title("Email Data Processor")
-    root.geometry("400x400")
+    root.geometry("400x600")
     root.resizable(False, False)
 
     frame = tk.Frame(root, padx=20, pady=20)
@@ -211,12 +253,27 @@ def main():
     )
 
     # Buttons
-    tk.Button(
-        frame, text="Extract Emails", command=extract_emails, width=25, height=2
-    ).pack(pady=10, padx=10)
-    tk.Button(
-        frame, text="Create Excel File", command=create_excel_file, width=25, height=2
-    ).pack(pady=10, padx=10)
+    action_buttons = [
+        tk.Button(
+            frame, text="Extract Emails", command=extract_emails, width=25, height=2
+        ),
+        tk.Button(
+            frame,
+            text="Re-extract From Archive",
+            command=reextract_archive,
+            width=25,
+            height=2,
+        ),
+        tk.Button(
+            frame,
+            text="Create Excel File",
+            command=create_excel_file,
+            width=25,
+            height=2,
+        ),
+    ]
+    for button in action_buttons:
+        button.pack(pady=10, padx=10)
 
     # Progress bar
     progress_bar = ttk.Progressbar(
@@ -224,6 +281,11 @@ def main():
     )
     progress_bar.pack(pady=10)
 
+    cancel_button = tk.Button(
+        frame, text="Cancel", command=cancel_run, width=10, state="disabled"
+    )
+    cancel_button.pack()
+
     # Status label
     status_label = tk.Label(frame, text="", font=("Arial", 12), justify="left")
     status_label.pack(pady=20)
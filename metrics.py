@@ -0,0 +1,175 @@
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+# Pipeline stages, in the order they are reported
+STAGES = ["list", "fetch", "throttle", "decode", "dedup", "parse", "write", "run"]
+
+
+class _StageTimer:
+    """Context manager adding the elapsed time of its body to a sample list."""
+
+    __slots__ = ("profiler", "name", "started")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.samples[self.name].append(time.perf_counter() - self.started)
+        if exc_type is not None:
+            self.profiler.failures[self.name] += 1
+        return False
+
+
+class _NullTimer:
+    """Shared no-op context manager used while profiling is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class StageProfiler:
+    """Collects per-stage durations and failure counts for one run."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.failures = defaultdict(int)
+
+    def stage(self, name):
+        return _StageTimer(self, name)
+
+    def record(self, name, seconds):
+        self.samples[name].append(seconds)
+
+    def fail(self, name, count=1):
+        self.failures[name] += count
+
+    def summary(self):
+        """Return one dict of totals and percentiles per stage that ran."""
+        rows = []
+        for name in STAGES + sorted(set(self.samples) - set(STAGES)):
+            samples = sorted(self.samples.get(name, []))
+            failures = self.failures.get(name, 0)
+            if not samples and not failures:
+                continue
+            rows.append({
+                "stage": name,
+                "calls": len(samples),
+                "total_seconds": sum(samples),
+                "p50_seconds": _percentile(samples, 0.50),
+                "p95_seconds": _percentile(samples, 0.95),
+                "max_seconds": samples[-1] if samples else 0.0,
+                "failures": failures,
+            })
+        return rows
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+# The profiler of the run in progress on each thread, unset while profiling
+# is disabled; runs on different threads are profiled separately
+_runs = threading.local()
+
+
+def _active():
+    return getattr(_runs, "profiler", None)
+
+
+def start_run():
+    """Start collecting stage timings for a new run on this thread."""
+    _runs.profiler = StageProfiler()
+    return _runs.profiler
+
+
+def stop_run():
+    """Stop collecting and return the profiler of the finished run."""
+    profiler, _runs.profiler = _active(), None
+    return profiler
+
+
+def stage(name):
+    """Time a block as part of stage name: `with metrics.stage("fetch"):`."""
+    profiler = _active()
+    if profiler is None:
+        return _NULL_TIMER
+    return _StageTimer(profiler, name)
+
+
+def record(name, seconds):
+    """Add a duration measured elsewhere, e.g. in a parse worker process."""
+    profiler = _active()
+    if profiler is not None:
+        profiler.record(name, seconds)
+
+
+def fail(name, count=1):
+    """Count a failure in stage name."""
+    profiler = _active()
+    if profiler is not None:
+        profiler.fail(name, count)
+
+
+def save_metrics(log_id, profiler, db_path="orders.db"):
+    """Store the stage summary of a run, linked to its extraction_logs row."""
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        """INSERT INTO extraction_metrics (log_id, stage, calls, total_seconds,
+               p50_seconds, p95_seconds, max_seconds, failures)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (log_id, row["stage"], row["calls"], row["total_seconds"],
+             row["p50_seconds"], row["p95_seconds"], row["max_seconds"], row["failures"])
+            for row in profiler.summary()
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+def format_report(runs=5, db_path="orders.db"):
+    """Return a text table comparing the stage timings of the latest runs."""
+    conn = sqlite3.connect(db_path)
+    logs = conn.execute(
+        """SELECT id, timestamp, account FROM extraction_logs
+           WHERE id IN (SELECT log_id FROM extraction_metrics)
+           ORDER BY id DESC LIMIT ?""",
+        (runs,),
+    ).fetchall()
+    lines = []
+    for log_id, timestamp, account in logs:
+        lines.append(f"Run {log_id}{f' ({account})' if account else ''} at {timestamp}")
+        lines.append(
+            f"  {'stage':<8} {'calls':>7} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'failed':>7}"
+        )
+        rows = conn.execute(
+            """SELECT stage, calls, total_seconds, p50_seconds, p95_seconds,
+                      max_seconds, failures
+               FROM extraction_metrics WHERE log_id = ?""",
+            (log_id,),
+        ).fetchall()
+        rows.sort(key=lambda row: STAGES.index(row[0]) if row[0] in STAGES else len(STAGES))
+        for name, calls, total, p50, p95, maximum, failures in rows:
+            lines.append(
+                f"  {name:<8} {calls:>7} {total:>9.2f} {p50 * 1000:>9.1f} "
+                f"{p95 * 1000:>9.1f} {maximum * 1000:>9.1f} {failures:>7}"
+            )
+    conn.close()
+    return "\n".join(lines) if lines else "No profiled runs yet."
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor
+from extract import DatabaseWriter, content_fingerprint, extract_data_from_html
+import metrics
+
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_QUEUE_SIZE = 64  # Messages waiting for or being parsed at any time
+
+
+def parse_message(msg_id, html_parts):
+    """Parse the HTML bodies of one message into plain records.
+
+    Runs in a worker process. Returns (msg_id, records, error, seconds) where
+    records is a list of (customer, order, products, order_items) tuples,
+    error is a message string if parsing failed and seconds is the parse time.
+    """
+    started = time.perf_counter()
+    try:
+        records = [extract_data_from_html(html_content) for html_content in html_parts]
+    except Exception as error:
+        seconds = time.perf_counter() - started
+        return msg_id, [], f"{type(error).__name__}: {error}", seconds
+    return msg_id, records, None, time.perf_counter() - started
+
+
+def parse_pool(workers=PARSE_WORKERS):
+    """Start a process pool for parse_message.
+
+    The pipeline runs next to other threads (the GUI, or the other accounts
+    of ingest.run_accounts), and forking a multi-threaded process can
+    deadlock the child, so workers come from a fork server, or are spawned
+    where there is none.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["pipeline"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+class SharedPool:
+    """
+    A parse pool several pipelines submit to, started by the first submit,
+    so that runs which parse everything in their own thread start no
+    processes. Use as a context manager, like ProcessPoolExecutor.
+    """
+
+    def __init__(self, workers=PARSE_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            if self.pool is None:
+                self.pool = parse_pool(self.workers)
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+def run_pipeline(
+    fetched,
+    writer=None,
+    workers=PARSE_WORKERS,
+    queue_size=PARSE_QUEUE_SIZE,
+    on_progress=None,
+    cancel=None,
+    dedup=True,
+    executor=None,
+):
+    """Parse fetched messages in a process pool and write them from this thread.
+
+    fetched yields (msg_id, html_parts) pairs, html_parts None for a message
+    that could not be fetched. Results go to writer (one is opened if not
+    given) in input order, with at most queue_size messages in flight, and
+    on_progress(msg_id) is called after each. cancel stops taking messages;
+    dedup skips content already ingested. Parsing runs in executor if given,
+    otherwise in a new process pool of size workers. Returns (msg_id, error)
+    pairs for the messages that failed.
+    """
+    failures = []
+    pending = deque()
+    own_writer = writer is None
+    if own_writer:
+        writer = DatabaseWriter()
+
+    def drain_one():
+        future, fingerprint = pending.popleft()
+        msg_id, records, error, seconds = future.result()
+        if seconds is not None:
+            metrics.record("parse", seconds)
+        if records is None:
+            writer.add_duplicate(msg_id, fingerprint)
+        elif error is None:
+            writer.add(msg_id, records, fingerprint)
+        else:
+            if seconds is not None:
+                metrics.fail("parse")
+            if fingerprint is not None:
+                writer.release(fingerprint)
+            print(f"An error occurred in processing message {msg_id}: {error}")
+            failures.append((msg_id, error))
+        if on_progress:
+            on_progress(msg_id)
+
+    with (
+        nullcontext(executor) if executor is not None else parse_pool(workers)
+    ) as pool:
+        for msg_id, html_parts in fetched:
+            if cancel is not None and cancel.is_set():
+                break
+            fingerprint = is_new = None
+            if html_parts and dedup:
+                with metrics.stage("dedup"):
+                    fingerprint = content_fingerprint(html_parts)
+                    is_new = writer.claim(fingerprint)
+            if html_parts is None:
+                future = Future()
+                future.set_result((msg_id, [], "message could not be fetched", None))
+            elif is_new is False:
+                # Already ingested: no parse, the message is only marked processed
+                future = Future()
+                future.set_result((msg_id, None, None, None))
+            else:
+                future = pool.submit(parse_message, msg_id, html_parts)
+            pending.append((future, fingerprint))
+            while len(pending) >= queue_size:
+                drain_one()
+        while pending:
+            drain_one()
+
+    writer.flush()
+    if own_writer:
+        writer.close()
+    return failures + writer.failures
+
@@ -0,0 +1,190 @@
+import random
+import threading
+import time
+import weakref
+import metrics
+
+# Gmail API quota cost of each call we make, in quota units
+QUOTA_UNITS = {
+    "messages.get": 5,
+    "messages.list": 5,
+    "messages.attachments.get": 5,
+    "history.list": 2,
+    "getProfile": 1,
+}
+QUOTA_UNITS_PER_SECOND = 250  # Gmail per-user limit
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5  # Seconds, doubled on each retry
+BACKOFF_CAP = 32.0
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 50  # Gmail recommends at most 50 requests per batch
+BATCH_LIMIT = 100  # Gmail rejects larger batches
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+def is_rate_limited(error):
+    """Return True if error is Gmail telling us to slow down."""
+    from googleapiclient.errors import HttpError  # Loaded with the service
+
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and any(
+        reason in str(error.content) for reason in RATE_LIMIT_REASONS
+    )
+
+
+def is_retryable(error):
+    """Return True if the failed request may succeed when retried."""
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES or is_rate_limited(error)
+    # Connection resets, timeouts and the like
+    return isinstance(error, (OSError, TimeoutError))
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry attempt."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+class RequestScheduler:
+    """Paces Gmail calls to the per-user quota and retries transient errors.
+
+    Quota units are drawn from a token bucket refilled at units_per_second.
+    The batch size used by ingest.fetch_messages, i.e. the number of
+    requests in flight, adapts AIMD-style: it is halved whenever Gmail
+    reports a rate limit and grows by one after each batch that went through
+    cleanly, up to max_batch_size.
+
+    With an auth.SessionPool as sessions, every call borrows an authorized
+    session from the pool, so concurrent callers don't share a connection.
+    """
+
+    def __init__(
+        self, units_per_second=QUOTA_UNITS_PER_SECOND, max_batch_size=MAX_BATCH_SIZE, sessions=None
+    ):
+        self.sessions = sessions
+        self.units_per_second = units_per_second
+        self.tokens = float(units_per_second)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_max_batch_size(max_batch_size)
+
+    def set_max_batch_size(self, max_batch_size):
+        """Cap the batch size, starting from the cap."""
+        if not MIN_BATCH_SIZE <= max_batch_size <= BATCH_LIMIT:
+            raise ValueError(
+                f"max_batch_size must be between {MIN_BATCH_SIZE} and {BATCH_LIMIT}, not {max_batch_size!r}"
+            )
+        with self.lock:
+            self.max_batch_size = self.batch_size = max_batch_size
+
+    def acquire(self, units):
+        """Block until units quota units are available, then take them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.units_per_second,
+                self.tokens + (now - self.updated) * self.units_per_second,
+            )
+            self.updated = now
+            self.tokens -= units
+            wait = -self.tokens / self.units_per_second if self.tokens < 0 else 0.0
+        if wait:
+            metrics.record("throttle", wait)
+            time.sleep(wait)
+
+    def on_rate_limited(self):
+        with self.lock:
+            self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+
+    def on_success(self):
+        with self.lock:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+
+    def _send(self, request):
+        """Execute a request or batch, over a pooled session if there is one."""
+        if self.sessions is None:
+            return request.execute()
+        with self.sessions.session() as http:
+            return request.execute(http=http)
+
+    def execute(self, request, method):
+        """Execute a single request, retrying transient errors.
+
+        method is a key of QUOTA_UNITS, e.g. "messages.list".
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire(QUOTA_UNITS[method])
+            try:
+                return self._send(request)
+            except Exception as error:
+                if attempt == MAX_RETRIES or not is_retryable(error):
+                    raise
+                if is_rate_limited(error):
+                    self.on_rate_limited()
+                time.sleep(backoff_delay(attempt))
+
+    def execute_batch(self, service, requests, method):
+        """Execute (request_id, request) pairs as one batch request.
+
+        Returns (responses, retry, errors): responses and errors map request
+        IDs to their result, retry lists the IDs that failed transiently and
+        should be sent again.
+        """
+        responses, errors, retry = {}, {}, []
+        rate_limited = False
+
+        def callback(request_id, response, exception):
+            nonlocal rate_limited
+            if exception is None:
+                responses[request_id] = response
+            elif is_retryable(exception):
+                rate_limited = rate_limited or is_rate_limited(exception)
+                retry.append(request_id)
+            else:
+                errors[request_id] = exception
+
+        self.acquire(QUOTA_UNITS[method] * len(requests))
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id, request in requests:
+            batch.add(request, request_id=request_id)
+        try:
+            self._send(batch)
+        except Exception as error:
+            # The whole batch failed, e.g. a dropped connection
+            if not is_retryable(error):
+                raise
+            rate_limited = rate_limited or is_rate_limited(error)
+            done = set(responses) | set(errors)
+            retry = [request_id for request_id, _ in requests if request_id not in done]
+
+        if rate_limited:
+            self.on_rate_limited()
+        elif not retry:
+            self.on_success()
+        return responses, retry, errors
+
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def scheduler_for(service, sessions=None, max_batch_size=None):
+    """Return the scheduler of a service; quota is tracked per mailbox.
+
+    sessions is only used by the first call, which creates the scheduler.
+    max_batch_size, if given, caps the requests in flight from then on.
+    """
+    scheduler = _schedulers.get(service)
+    if scheduler is None:
+        scheduler = _schedulers[service] = RequestScheduler(
+            max_batch_size=max_batch_size or MAX_BATCH_SIZE, sessions=sessions
+        )
+    elif max_batch_size:
+        scheduler.set_max_batch_size(max_batch_size)
+    return scheduler
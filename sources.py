@@ -0,0 +1,173 @@
+import mailbox
+import os
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+import metrics
+from scheduler import scheduler_for
+from ingest import (
+    EARLY_STOP_PAGES,
+    WAYFAIR_TITLE,
+    fetch_html,
+    get_gmail_service,
+    filter_unprocessed,
+    list_new_messages,
+)
+
+# Message sources for ingest.run_ingestion. Each source lists the IDs of its
+# unprocessed messages with list_new() and yields (msg_id, html_parts) pairs
+# for them, in order, from fetch(); html_parts is None when a message can't
+# be read. history_id is the watermark to log once the run succeeds, and
+# account the mailbox its messages are marked processed for. connect() does
+# anything interactive up front, before ingest.run_accounts starts threads.
+
+
+def get_email_html_parts(message):
+    """Return the decoded text/html bodies of an email.message.Message."""
+    html_parts = []
+    for part in message.walk():
+        if part.get_content_type() == "text/html" and not part.is_multipart():
+            payload = part.get_payload(decode=True) or b""
+            charset = part.get_content_charset() or "utf-8"
+            html_parts.append(payload.decode(charset, errors="replace"))
+    return html_parts
+
+
+def _message_key(headers, fallback):
+    """Use the Message-ID header as the processed_emails key, if there is one."""
+    message_id = headers.get("Message-ID")
+    return message_id.strip().strip("<>") if message_id else fallback
+
+
+def _is_wanted(headers, title):
+    return title.lower() in str(headers.get("Subject", "")).lower()
+
+
+class GmailSource:
+    """Messages with the PO title in a Gmail mailbox, listed incrementally.
+
+    account names the token the mailbox is read with (see auth.list_accounts).
+    max_batch_size caps the messages fetched per batch request, and a full
+    scan stops after stop_after_processed_pages fully processed pages in a
+    row (0 scans the whole mailbox).
+    """
+
+    def __init__(
+        self,
+        service=None,
+        user_id="me",
+        title=WAYFAIR_TITLE,
+        account="",
+        max_batch_size=None,
+        stop_after_processed_pages=EARLY_STOP_PAGES,
+    ):
+        self.service = service
+        self.user_id = user_id
+        self.title = title
+        self.account = account
+        self.max_batch_size = max_batch_size
+        self.stop_after_processed_pages = stop_after_processed_pages
+        self.history_id = None
+
+    def connect(self):
+        """Authorize the account, in the browser if it has no usable token."""
+        if self.service is None:
+            self.service = get_gmail_service(self.account, self.max_batch_size)
+        elif self.max_batch_size:
+            scheduler_for(self.service, max_batch_size=self.max_batch_size)
+
+    def list_new(self):
+        self.connect()
+        messages, self.history_id = list_new_messages(
+            self.service,
+            self.user_id,
+            self.title,
+            self.account,
+            self.stop_after_processed_pages,
+        )
+        return [message["id"] for message in messages]
+
+    def fetch(self, msg_ids, archive=None):
+        return fetch_html(self.service, msg_ids, self.user_id, archive=archive)
+
+
+class EmlDirectorySource:
+    """Messages with the PO title among the .eml files of a directory."""
+
+    history_id = None
+    account = ""
+
+    def __init__(self, directory, title=WAYFAIR_TITLE):
+        self.directory = directory
+        self.title = title
+        self.paths = {}
+
+    def connect(self):
+        pass
+
+    def list_new(self):
+        header_parser = BytesHeaderParser(policy=policy.default)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.lower().endswith(".eml"):
+                continue
+            path = os.path.join(self.directory, name)
+            with open(path, "rb") as eml_file:
+                headers = header_parser.parse(eml_file)
+            if _is_wanted(headers, self.title):
+                self.paths[_message_key(headers, name)] = path
+        new_ids = filter_unprocessed(list(self.paths))
+        print(f"Found {len(new_ids)} new messages.")
+        return new_ids
+
+    def fetch(self, msg_ids, archive=None):
+        parser = BytesParser(policy=policy.default)
+        for msg_id in msg_ids:
+            try:
+                with metrics.stage("decode"), open(self.paths[msg_id], "rb") as eml_file:
+                    html_parts = get_email_html_parts(parser.parse(eml_file))
+            except Exception as error:
+                print(f"An error occurred reading {self.paths[msg_id]}: {error}")
+                yield msg_id, None
+                continue
+            if archive is not None:
+                archive.store(msg_id, html_parts)
+            yield msg_id, html_parts
+
+
+class MboxSource:
+    """Messages with the PO title in an mbox file."""
+
+    history_id = None
+    account = ""
+
+    def __init__(self, path, title=WAYFAIR_TITLE):
+        self.mbox = mailbox.mbox(path, create=False)
+        self.title = title
+        self.keys = {}
+
+    def connect(self):
+        pass
+
+    def list_new(self):
+        header_parser = BytesHeaderParser(policy=policy.default)
+        for key in self.mbox.iterkeys():
+            headers = header_parser.parsebytes(self.mbox.get_bytes(key))
+            if _is_wanted(headers, self.title):
+                self.keys[_message_key(headers, f"mbox-{key}")] = key
+        new_ids = filter_unprocessed(list(self.keys))
+        print(f"Found {len(new_ids)} new messages.")
+        return new_ids
+
+    def fetch(self, msg_ids, archive=None):
+        parser = BytesParser(policy=policy.default)
+        for msg_id in msg_ids:
+            try:
+                with metrics.stage("decode"):
+                    message = parser.parsebytes(self.mbox.get_bytes(self.keys[msg_id]))
+                    html_parts = get_email_html_parts(message)
+            except Exception as error:
+                print(f"An error occurred reading mbox message {msg_id}: {error}")
+                yield msg_id, None
+                continue
+            if archive is not None:
+                archive.store(msg_id, html_parts)
+            yield msg_id, html_parts
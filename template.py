@@ -0,0 +1,231 @@
+import re
+from extract import ANCHORS, CUSTOMER_ANCHOR, ORDER_ANCHOR, PRODUCTS_ANCHOR, normalize_date
+
+# Fast path for extract_data_from_html. The PO emails all come from one
+# vendor template, so instead of building a BeautifulSoup tree and searching
+# it for every message, the document is parsed with lxml and the fields are
+# read at column positions compiled once per template version. A version is
+# identified by its structural fingerprint: the header texts of the order,
+# customer and item tables. Anything the fast path isn't sure about returns
+# None, and the caller falls back to the BeautifulSoup extractors, whose
+# results this module reproduces exactly (see benchmarks/differential.py).
+
+MAX_TEMPLATES = 64  # Compiled template versions kept; more means the headers vary per email
+ITEM_COLUMNS = 6  # Qty, Item Code, Description, ..., price in the sixth column
+
+# orders column -> header text, as read by extract.extract_order
+ORDER_HEADERS = {
+    "po_number": "PO Number",
+    "sold_on": "Sold On",
+    "must_ship_by": "Must Ship By",
+    "ship_method": "Ship Method",
+    "delivery_type": "Delivery Type",
+    "payment_method": "Payment Method",
+}
+
+_templates = {}  # fingerprint -> Template, or None for unsupported layouts
+_SPACES = re.compile(r"\s{2,}")
+
+
+def _text(element):
+    """All text inside element, like Tag.get_text()."""
+    return "".join(element.itertext())
+
+
+def _string(element):
+    """The only text of element, like Tag.string: None if it has mixed content."""
+    children = list(element)
+    if not children:
+        return element.text
+    if len(children) == 1 and not element.text and not children[0].tail:
+        child = children[0]
+        if not isinstance(child.tag, str):  # A comment
+            return child.text
+        return _string(child)
+    return None
+
+
+def _first(elements):
+    return next(elements, None)
+
+
+def _inner_table_for(h5):
+    """Same as extract._inner_table_for, on an lxml element."""
+    # Navigate up the tree: h5 -> td -> tr -> tbody -> table
+    element = h5
+    for tag in ("td", "tr", "tbody", "table"):
+        element = _first(element.iterancestors(tag))
+        if element is None:
+            return None
+    if _first(element.iterdescendants("table")) is not None:
+        return None
+    return element
+
+
+def _table_index(root):
+    """Same as extract.build_table_index, on an lxml document."""
+    index = {}
+    pending = list(ANCHORS)
+    for h5 in root.iter("h5"):
+        text = _string(h5)
+        if not text:
+            continue
+        for anchor in [a for a in pending if a in text]:
+            table = _inner_table_for(h5)
+            if table is not None:
+                index[anchor] = table
+                pending.remove(anchor)
+        if not pending:
+            break
+    return index
+
+
+def _header_row(table):
+    return _first(table.iter("tr"))
+
+
+def _cell_headers(row):
+    """Text of the first h5 of every cell, None for a cell without one."""
+    headers = []
+    for td in row.iter("td"):
+        h5 = _first(td.iter("h5"))
+        headers.append(None if h5 is None else _text(h5).strip())
+    return tuple(headers)
+
+
+class Template:
+    """Column positions of one template version, compiled from its fingerprint."""
+
+    __slots__ = ("order_headers", "order_columns", "customer_column", "ship_to_column")
+
+    def __init__(self, order_headers, customer_headers):
+        self.order_headers = len(order_headers)
+        # Later columns win for repeated headers, as in extract_order
+        positions = {header: i for i, header in enumerate(order_headers)}
+        self.order_columns = {
+            field: positions.get(header) for field, header in ORDER_HEADERS.items()
+        }
+        self.customer_column = self.ship_to_column = None
+        for i, header in enumerate(customer_headers):
+            if header == "Customer":
+                self.customer_column = i
+            elif header == "Ship To":
+                self.ship_to_column = i
+
+
+def compile_template(fingerprint):
+    """Return the Template for a fingerprint, or None if it isn't supported."""
+    order_headers, customer_headers, item_headers = fingerprint
+    if None in customer_headers or len(item_headers) < ITEM_COLUMNS:
+        return None
+    return Template(order_headers, customer_headers)
+
+
+def template_for(fingerprint):
+    if fingerprint not in _templates:
+        if len(_templates) >= MAX_TEMPLATES:
+            _templates.clear()
+        _templates[fingerprint] = compile_template(fingerprint)
+    return _templates[fingerprint]
+
+
+def _cell_values(cell):
+    """Non-empty h5 texts of a cell."""
+    return [text for text in (_text(h5).strip() for h5 in cell.iter("h5")) if text]
+
+
+def _extract_customer(template, table):
+    customer = {"name": "", "address": "", "phone_number": "", "email_address": ""}
+    if template.customer_column is None and template.ship_to_column is None:
+        return customer
+    data_row = _first(_header_row(table).itersiblings("tr"))
+    cells = list(data_row.iter("td"))
+    primary = template.customer_column if template.customer_column is not None else template.ship_to_column
+    values = _cell_values(cells[primary])
+    if values:
+        customer["name"] = values[0]
+    customer["address"] = ", ".join(_SPACES.sub(" ", value).strip() for value in values[1:])
+    if template.customer_column is not None and template.ship_to_column is not None:
+        for text in _cell_values(cells[template.ship_to_column]):
+            if text.replace("-", "").replace("(", "").replace(")", "").replace(" ", "").replace("+", "").isdigit():
+                customer["phone_number"] = text
+            elif "@" in text and "." in text:
+                customer["email_address"] = text
+    return customer
+
+
+def _extract_order(template, table, customer_name):
+    header_row = _header_row(table)
+    cells = list(_first(header_row.itersiblings("tr")).iter("td"))
+    if len(cells) < template.order_headers:
+        return None  # extract_order raises IndexError; let it
+    order = dict.fromkeys(
+        ("po_number", "customer_name", "sold_on", "must_ship_by", "ship_method",
+         "delivery_type", "payment_method"),
+        "",
+    )
+    for field, column in template.order_columns.items():
+        if column is not None:
+            order[field] = " ".join(_cell_values(cells[column]))
+    order["sold_on"] = normalize_date(order["sold_on"])
+    order["must_ship_by"] = normalize_date(order["must_ship_by"])
+    order["customer_name"] = customer_name
+    return order
+
+
+def _extract_items(table, po_number):
+    products, order_items, lines_per_code = [], [], {}
+    for row in list(table.iter("tr"))[1:]:
+        cells = list(row.iter("td"))
+        quantity = _text(_first(cells[0].iter("h5"))).strip()
+        item_code = _text(_first(cells[1].iter("h5"))).strip()
+        description = _SPACES.sub(" ", _text(_first(cells[2].iter("h5")))).strip()
+        price = float(_text(_first(cells[5].iter("h5"))).strip().replace("$", "").replace(",", ""))
+        line_number = lines_per_code.get(item_code, 0) + 1
+        lines_per_code[item_code] = line_number
+        if line_number == 1:
+            products.append({"item_code": item_code, "description": description})
+        order_items.append({
+            "order_po_number": po_number,
+            "product_item_code": item_code,
+            "quantity": int(quantity),
+            "price": price,
+            "line_number": line_number,
+        })
+    return products, order_items
+
+
+def extract_with_template(html_content):
+    """Return (customer, order, products, order_items) like extract_data_from_html.
+
+    Returns None when the fast path can't vouch for the result: lxml isn't
+    installed, the bytes aren't UTF-8, a table is missing, the template
+    version isn't supported or a value doesn't parse.
+    """
+    try:
+        import lxml.html
+    except ImportError:
+        return None
+    try:
+        if isinstance(html_content, bytes):
+            html_content = html_content.decode("utf-8")
+        root = lxml.html.document_fromstring(html_content)
+        tables = _table_index(root)
+        if len(tables) < len(ANCHORS):
+            return None
+        fingerprint = (
+            tuple(_text(h5).strip() for h5 in _header_row(tables[ORDER_ANCHOR]).iter("h5")),
+            _cell_headers(_header_row(tables[CUSTOMER_ANCHOR])),
+            _cell_headers(_header_row(tables[PRODUCTS_ANCHOR])),
+        )
+        template = template_for(fingerprint)
+        if template is None:
+            return None
+        customer = _extract_customer(template, tables[CUSTOMER_ANCHOR])
+        order = _extract_order(template, tables[ORDER_ANCHOR], customer["name"])
+        if order is None or not order["po_number"]:
+            return None
+        products, order_items = _extract_items(tables[PRODUCTS_ANCHOR], order["po_number"])
+    except (ValueError, TypeError, AttributeError, IndexError, UnicodeDecodeError):
+        return None
+    return customer, order, products, order_items